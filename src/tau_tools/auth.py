@@ -0,0 +1,193 @@
+"""
+A shared store for the TAU single sign-on (NIDP) session.
+Both `IMS` and `Moodle` sign in through NIDP, so passing the same `SessionStore` to both
+reuses a single NIDP login, and persisting it lets later runs skip signing in altogether.
+"""
+
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from rich.prompt import Prompt
+
+from tau_tools.logging import console
+from tau_tools.utilities import (
+    DEFAULT_RETRY_POLICY,
+    RateLimitedAdapter,
+    RateLimiter,
+    RetryPolicy,
+    send,
+)
+
+NIDP_SSO_URL = "https://nidp.tau.ac.il/nidp/saml2/sso"
+
+
+def sign_in_to_nidp(
+    session: requests.Session,
+    username: str,
+    id: str,
+    password: str,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+) -> requests.Response:
+    """
+    Signs in to NIDP, after a service redirected the `session` to it.
+    Returns the final response, which contains the SAML response for the service.
+    """
+
+    send(
+        "post",
+        NIDP_SSO_URL + "?id=10&sid=0&option=credential",
+        session,
+        retry_policy,
+    )
+    send(
+        "post",
+        NIDP_SSO_URL + "?sid=0",
+        session,
+        retry_policy,
+        data={
+            "option": "credential",
+            "Ecom_User_ID": username,
+            "Ecom_User_Pid": id,
+            "Ecom_Password": password,
+        },
+    )
+    return send("get", NIDP_SSO_URL + "?sid=0", session, retry_policy)
+
+
+def get_credentials(
+    username: Optional[str] = None,
+    id: Optional[str] = None,
+    password: Optional[str] = None,
+) -> Tuple[str, str, str]:
+    """
+    Returns the given credentials, falling back to the `TAU_TOOLS_USERNAME`, `TAU_TOOLS_ID` and
+    `TAU_TOOLS_PASSWORD` environment variables, and prompting for whatever is still missing.
+    """
+
+    username = username or os.environ.get("TAU_TOOLS_USERNAME")
+    id = id or os.environ.get("TAU_TOOLS_ID")
+    password = password or os.environ.get("TAU_TOOLS_PASSWORD")
+
+    if not username:
+        username = Prompt.ask("Enter your Moodle username", console=console)
+    if not id:
+        id = Prompt.ask("Enter your ID", console=console)
+    if not password:
+        password = Prompt.ask("Enter your Moodle password", console=console)
+
+    return username, id, password
+
+
+class SessionStore:
+    """
+    Holds a session shared by several clients of the same user, along with the state of every
+    client (e.g. the Moodle `sesskey`), optionally persisted to `session_file`.
+    Clients re-authenticate through `reauthenticate`, so that when several threads notice an
+    expired session at once, only one of them signs in again.
+    """
+
+    def __init__(
+        self,
+        username: str,
+        id: str,
+        password: str,
+        session_file: Optional[str] = None,
+        retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+        max_connections=10,
+        sign_in_semaphore: Optional[threading.Semaphore] = None,
+        rate_limiters: Optional[Dict[str, RateLimiter]] = None,
+    ):
+        """
+        `sign_in_semaphore` can be shared between stores to bound the concurrent sign-ins, and
+        `rate_limiters` (keyed by the host) to limit the requests of all of their sessions.
+        """
+
+        self.username = username
+        self.id = id
+        self.password = password
+        self.session_file = session_file
+        self.retry_policy = retry_policy
+        self.lock = threading.RLock()
+        self.sign_in_semaphore = sign_in_semaphore
+        self.sign_ins = 0
+
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            (
+                HTTPAdapter(pool_maxsize=max_connections)
+                if rate_limiters is None
+                else RateLimitedAdapter(rate_limiters, pool_maxsize=max_connections)
+            ),
+        )
+        self.is_signed_in_to_nidp = False
+        self.clients: Dict[str, Dict[str, Any]] = {}
+
+        if session_file is not None and os.path.exists(session_file):
+            with open(session_file, "r") as f:
+                session_info = json.load(f)
+
+            for cookie in session_info.get("cookies", []):
+                self.session.cookies.set(**cookie)
+            self.is_signed_in_to_nidp = session_info.get("is_signed_in_to_nidp", False)
+            self.clients = session_info.get("clients", {})
+
+    def sign_in_to_nidp(self) -> requests.Response:
+        with self.lock:
+            response = sign_in_to_nidp(
+                self.session, self.username, self.id, self.password, self.retry_policy
+            )
+            self.is_signed_in_to_nidp = True
+            return response
+
+    def reauthenticate(
+        self,
+        client: str,
+        stale_state: Optional[Dict[str, Any]],
+        sign_in: Callable[[], Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        """
+        Signs the `client` in again using `sign_in`, which returns the new state of the client.
+        If the state already changed from `stale_state`, another thread has already signed in
+        and its state is returned instead.
+        """
+
+        with self.lock:
+            state = self.clients.get(client)
+            if state is not None and state is not stale_state:
+                return state
+
+            if self.sign_in_semaphore is not None:
+                with self.sign_in_semaphore:
+                    self.clients[client] = sign_in()
+            else:
+                self.clients[client] = sign_in()
+            self.sign_ins += 1
+            self.save()
+            return self.clients[client]
+
+    def save(self):
+        if self.session_file is None:
+            return
+
+        with self.lock, open(self.session_file, "w") as f:
+            json.dump(
+                {
+                    "cookies": [
+                        {
+                            "name": cookie.name,
+                            "value": cookie.value,
+                            "domain": cookie.domain,
+                            "path": cookie.path,
+                        }
+                        for cookie in self.session.cookies
+                    ],
+                    "is_signed_in_to_nidp": self.is_signed_in_to_nidp,
+                    "clients": self.clients,
+                },
+                f,
+            )
@@ -3,8 +3,9 @@ from dataclasses import dataclass
 
 from bs4 import BeautifulSoup
 
+from tau_tools.instrumentation import instrumentation
 from tau_tools.logging import progress, setup_logging
-from tau_tools.utilities import request
+from tau_tools.utilities import has_markers, request
 
 
 @dataclass
@@ -67,24 +68,26 @@ def main(output_file="bidding.json"):
 
             for semester in ["1", "2", "3"]:
                 for run in ["1", "2", "3"]:
-                    page = BeautifulSoup(
-                        request(
-                            "POST",
-                            "https://www.ims.tau.ac.il/Bidd/Stats/Stats_L.aspx",
-                            data={
-                                "lstFacBidd": faculty,
-                                "lstShana": "",
-                                "sem": semester,
-                                "ritza": run,
-                                "txtKurs": course,
-                                "txtKursName": "",
-                                "lstPageSize": "1000",
-                            },
-                            cache_category="bidding",
-                            cache_key=f"stats-{course}-{semester}-{run}",
-                        ),
-                        "html.parser",
+                    response_text = request(
+                        "POST",
+                        "https://www.ims.tau.ac.il/Bidd/Stats/Stats_L.aspx",
+                        data={
+                            "lstFacBidd": faculty,
+                            "lstShana": "",
+                            "sem": semester,
+                            "ritza": run,
+                            "txtKurs": course,
+                            "txtKursName": "",
+                            "lstPageSize": "1000",
+                        },
+                        cache_category="bidding",
+                        cache_key=f"stats-{course}-{semester}-{run}",
+                        # The statistics table is missing when there are no statistics, but the
+                        # search form is always there.
+                        validate=has_markers('id="__VIEWSTATE"'),
                     )
+                    with instrumentation.timer("parse"):
+                        page = BeautifulSoup(response_text, "html.parser")
 
                     table = page.find("table", {"id": "Grd1"})
                     rows = table.find_all("tr")[1:] if table is not None else []
@@ -136,9 +139,11 @@ def main(output_file="bidding.json"):
                         if len(with_faculty) != 0:
                             course_result[semester][group] = with_faculty
                 result[course] = course_result
-    with open(output_file, "w") as f:
+    with instrumentation.timer("json write"), open(output_file, "w") as f:
         json.dump(result, f, ensure_ascii=False)
 
+    instrumentation.report()
+
 
 if __name__ == "__main__":
     setup_logging()
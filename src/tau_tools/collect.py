@@ -1,133 +1,435 @@
 """
 Collects all of the scraped course data into a single `courses.json` which contains only
 the names of the courses and the semesters they were taught in.
+
+A manifest of the input hashes and the per-semester aggregates is kept between runs, so that
+only semester files which changed are reloaded, and only files whose content changed are rewritten.
 """
 
+import argparse
+import hashlib
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from tau_tools.logging import log, setup_logging
 
+MANIFEST_FILE = "collect-manifest.json"
+MATCH_REPORT_FILE = "exam-match-report.json"
 
-def main(output_file="courses.json"):
-    result = {}
 
-    courses_jsons = [
-        f
-        for f in sorted(os.listdir("."))[::-1]
-        if f.startswith("courses-") and f.endswith(".json")
-    ]
-    log.info(f"Found courses JSONs: {courses_jsons}")
+def _hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
 
-    semester_jsons = {}
 
-    for courses_json in courses_jsons:
-        semester = courses_json.removeprefix("courses-").removesuffix(".json")
-        log.info(f"Loading courses from {semester}")
+def _get_file_hash(path: str) -> Optional[str]:
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as f:
+        return _hash(f.read())
+
+
+def _write_if_changed(path: str, data: Any, current_hash: Optional[str] = None) -> str:
+    """
+    Writes `data` as JSON to `path` unless the file already contains it. Returns the hash of the content.
+    `current_hash` is the hash of the file, if it's already known.
+    """
+
+    content = json.dumps(data, ensure_ascii=False).encode()
+    content_hash = _hash(content)
+    if current_hash is None:
+        current_hash = _get_file_hash(path)
+    if current_hash != content_hash:
+        log.info(f"Writing {path}")
+        with open(path, "wb") as f:
+            f.write(content)
+
+    return content_hash
+
+
+def aggregate_semester(courses: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Returns the name, faculty and lecturers of every course in the semester."""
+
+    aggregate = {}
+    for course_id in courses:
+        lecturers = set()
+        for group in courses[course_id]["groups"]:
+            if group["lecturer"] is not None:
+                for lecturer in group["lecturer"].split(", "):
+                    if lecturer != "":
+                        lecturers.add(lecturer.replace(" ", " "))
+
+        aggregate[course_id] = {
+            "name": courses[course_id]["name"],
+            "faculty": courses[course_id]["faculty"],
+            "lecturers": sorted(lecturers),
+        }
+
+    return aggregate
+
 
-        with open(courses_json, "r") as f:
-            courses = json.load(f)
+def _get_file_stat(path: str) -> List[float]:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
 
-        semester_jsons[semester] = courses
 
-        for course_id in courses:
-            lecturers = set()
-            for group in courses[course_id]["groups"]:
-                if group["lecturer"] is not None:
-                    for lecturer in group["lecturer"].split(", "):
-                        if lecturer != "":
-                            lecturers.add(lecturer.replace(" ", " "))
+def summarize_semester(
+    path: str, previous_hash: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    Returns the hash, aggregate and exam links of the semester file at `path`,
+    or `None` if its hash is still `previous_hash`.
+    Runs in a worker process, so that only the summary is sent back rather than the whole semester.
+    """
 
+    with open(path, "rb") as f:
+        content = f.read()
+
+    file_hash = _hash(content)
+    if file_hash == previous_hash:
+        return None
+
+    courses = json.loads(content)
+    return {
+        "hash": file_hash,
+        "aggregate": aggregate_semester(courses),
+        "exam_links": {
+            course_id: course["exam_links"]
+            for course_id, course in courses.items()
+            if "exam_links" in course
+        },
+    }
+
+
+def merge_aggregates(
+    aggregates: Dict[str, Dict[str, Dict[str, Any]]],
+) -> Dict[str, Any]:
+    """Merges the aggregates of all of the semesters, preferring the details of the latest semester."""
+
+    result = {}
+    for semester in sorted(aggregates)[::-1]:
+        for course_id, course in aggregates[semester].items():
             if course_id not in result:
                 result[course_id] = {
-                    "name": courses[course_id]["name"],
-                    "faculty": courses[course_id]["faculty"],
+                    "name": course["name"],
+                    "faculty": course["faculty"],
                     "semesters": [semester],
-                    "lecturers": list(lecturers),
+                    "lecturers": course["lecturers"],
                 }
             else:
-                if result[course_id]["name"] != courses[course_id]["name"]:
+                if result[course_id]["name"] != course["name"]:
                     log.warning(
-                        f"Name mismatch of course {course_id}: changed from {courses[course_id]['name']} to {result[course_id]['name']}"
+                        f"Name mismatch of course {course_id}: changed from {course['name']} to {result[course_id]['name']}"
                     )
-                if result[course_id]["faculty"] != courses[course_id]["faculty"]:
+                if result[course_id]["faculty"] != course["faculty"]:
                     log.warning(
-                        f"Fcaulty mismatch of course {course_id}: changed from {courses[course_id]['faculty']} to {result[course_id]['faculty']}"
+                        f"Fcaulty mismatch of course {course_id}: changed from {course['faculty']} to {result[course_id]['faculty']}"
                     )
                 result[course_id]["semesters"].append(semester)
-                result[course_id]["lecturers"] = list(set(result[course_id]["lecturers"]).union(lecturers))
+                result[course_id]["lecturers"] = sorted(
+                    set(result[course_id]["lecturers"]).union(course["lecturers"])
+                )
+
+    return result
+
+
+DIGITS = "0123456789"
+
+
+@dataclass
+class ExamMatchReport:
+    matched: int = 0
+    proposed_corrections: Dict[str, str] = field(default_factory=dict)
+    """Corrections of exam course ids found by fuzzy matching, which were applied if enabled"""
+    ambiguous: Dict[str, List[str]] = field(default_factory=dict)
+    """Exam course ids with several fuzzy matches, which were left unmatched"""
+    unmatched: List[str] = field(default_factory=list)
+    """Filenames of the exams which couldn't be matched to any course"""
+    multiple_semesters: List[str] = field(default_factory=list)
+    """Course ids of exams which matched several semesters, and were added to the first one only"""
+
+
+def build_course_index(semester_course_ids: Dict[str, Set[str]]) -> Dict[str, Set[str]]:
+    """Returns the semesters of every course id."""
+
+    index: Dict[str, Set[str]] = {}
+    for semester, course_ids in semester_course_ids.items():
+        for course_id in course_ids:
+            index.setdefault(course_id, set()).add(semester)
+    return index
+
+
+def get_edit_neighbors(course_id: str) -> Set[str]:
+    """Returns all of the ids at an edit distance of 1 (including swapping adjacent digits) from `course_id`."""
+
+    neighbors = set()
+    for i in range(len(course_id) + 1):
+        for digit in DIGITS:
+            neighbors.add(course_id[:i] + digit + course_id[i:])
+        if i < len(course_id):
+            neighbors.add(course_id[:i] + course_id[i + 1 :])
+            for digit in DIGITS:
+                neighbors.add(course_id[:i] + digit + course_id[i + 1 :])
+        if i < len(course_id) - 1:
+            neighbors.add(
+                course_id[:i] + course_id[i + 1] + course_id[i] + course_id[i + 2 :]
+            )
+
+    neighbors.discard(course_id)
+    return neighbors
+
+
+def _parse_exam_filename(filename: str) -> Tuple[str, List[str]]:
+    """Returns the course id and the possible semesters (a and/or b) of the exam."""
 
-    with open(output_file, "w") as f:
-        json.dump(result, f, ensure_ascii=False)
+    exam_course_id = "".join(filename.split("-")[:2]).strip()
+    exam_course_id = exam_course_id.split(" ")[0]
 
-    if not os.path.exists("moodle-exams.json"):
-        return
+    semesters = ["a", "b"]
+    if "סמ א" in filename:
+        semesters = ["a"]
+    elif "סמ ב" in filename:
+        semesters = ["b"]
 
-    log.info("Found moodle exams JSON")
-    with open("moodle-exams.json", "r") as f:
-        moodle_exams = json.load(f)
+    return exam_course_id, semesters
 
-    corrections = {}
-    if os.path.exists("corrections.json"):
-        log.info("Found corrections JSON")
-        with open("corrections.json", "r") as f:
-            corrections = json.load(f)
+
+def match_exam_links(
+    moodle_exams: List[Dict[str, Any]],
+    corrections: Dict[str, str],
+    semester_course_ids: Dict[str, Set[str]],
+    auto_correct=False,
+) -> Tuple[Dict[str, Dict[str, List[str]]], ExamMatchReport]:
+    """
+    Matches the Moodle exams to the courses of the semesters.
+    Exam course ids which aren't found are fuzzy matched to course ids at an edit distance of 1
+    in the same years, and unique matches are proposed in the report. Since course ids are dense,
+    a match may be the wrong course, so the matches are only applied if `auto_correct` is set.
+    Returns the exam links of every course for every semester whose links are managed by the
+    exams, and a report of the matching.
+    """
+
+    index = build_course_index(semester_course_ids)
+    links: Dict[str, Dict[str, List[str]]] = {}
+    report = ExamMatchReport()
+
+    def find_semesters(course_id: str, year: int, semesters: List[str]) -> List[str]:
+        course_semesters = index.get(course_id, set())
+        # Account for +-1 errors in the year.
+        for y in [year, year + 1, year - 1]:
+            found = [
+                f"{y}{semester}"
+                for semester in semesters
+                if f"{y}{semester}" in course_semesters
+            ]
+            if len(found) != 0:
+                return found
+        return []
 
     for year_exams in moodle_exams:
-        year = year_exams["year"]
-        if f"{year}a" not in semester_jsons or f"{year}b" not in semester_jsons:
+        year = int(year_exams["year"])
+        if (
+            f"{year}a" not in semester_course_ids
+            or f"{year}b" not in semester_course_ids
+        ):
             log.warning(f"Missing JSON for {year}, skipping")
+            continue
 
-        # Remove existing links.
-        for course in list(semester_jsons[f"{year}a"].values()) + list(
-            semester_jsons[f"{year}b"].values()
-        ):
-            if "exam_links" in course:
-                course.pop("exam_links")
+        # Existing links of the year are replaced.
+        links.setdefault(f"{year}a", {})
+        links.setdefault(f"{year}b", {})
 
         for filename, url in year_exams["results"]:
-            exam_course_id = "".join(filename.split("-")[:2]).strip()
-            exam_course_id = exam_course_id.split(" ")[0]
-
+            exam_course_id, semesters = _parse_exam_filename(filename)
             if exam_course_id in corrections:
                 exam_course_id = corrections[exam_course_id]
 
-            semesters = ["a", "b"]
-            if "סמ א" in filename:
-                semesters = ["a"]
-            elif "סמ ב" in filename:
-                semesters = ["b"]
-
-            count = 0
-            # Account for +-1 errors in the year.
-            for y in [int(year), int(year) + 1, int(year) - 1]:
-                for semester in semesters:
-                    if f"{y}{semester}" not in semester_jsons:
-                        continue
-                    semester_courses = semester_jsons[f"{y}{semester}"]
-                    if exam_course_id in semester_courses:
-                        if "exam_links" not in semester_courses[exam_course_id]:
-                            semester_courses[exam_course_id]["exam_links"] = []
-                        count += 1
-                        if count == 1:
-                            semester_courses[exam_course_id]["exam_links"].append(url)
-
-                if count > 0:
-                    break
-            if count == 0:
-                log.error(
-                    f"Couldn't find {filename} in {year}",
+            found = find_semesters(exam_course_id, year, semesters)
+            if len(found) == 0:
+                candidates = sorted(
+                    neighbor
+                    for neighbor in get_edit_neighbors(exam_course_id)
+                    if len(find_semesters(neighbor, year, semesters)) != 0
                 )
-            elif count != 1:
-                log.warning(
-                    "Added to semester a only: " + exam_course_id,
+                if len(candidates) == 1:
+                    report.proposed_corrections[exam_course_id] = candidates[0]
+                    if auto_correct:
+                        exam_course_id = candidates[0]
+                        found = find_semesters(exam_course_id, year, semesters)
+                elif len(candidates) > 1:
+                    report.ambiguous[exam_course_id] = candidates
+
+            if len(found) == 0:
+                report.unmatched.append(filename)
+                continue
+
+            report.matched += 1
+            if len(found) > 1:
+                report.multiple_semesters.append(exam_course_id)
+            links.setdefault(found[0], {}).setdefault(exam_course_id, []).append(url)
+
+    log.info(
+        f"Matched {report.matched} exams, {len(report.unmatched)} unmatched, {len(report.proposed_corrections)} corrections proposed"
+    )
+    return links, report
+
+
+def main(
+    output_file="courses.json",
+    manifest_file=MANIFEST_FILE,
+    force=False,
+    auto_correct=False,
+    match_report_file=MATCH_REPORT_FILE,
+    max_workers: Optional[int] = None,
+):
+    """
+    Collects the courses JSONs in the current directory.
+    Changed semester files are summarized in up to `max_workers` processes, and are only fully
+    loaded when their exam links need to be patched.
+    Unless `force` is set, semester files which didn't change since the last run aren't reloaded.
+    Whenever the exam links are matched, a report of the matching is written to `match_report_file`.
+    """
+
+    manifest: Dict[str, Any] = {}
+    if not force and os.path.exists(manifest_file):
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+    previous_semesters: Dict[str, Dict[str, Any]] = manifest.get("semesters", {})
+
+    courses_jsons = [
+        f
+        for f in sorted(os.listdir("."))[::-1]
+        if f.startswith("courses-") and f.endswith(".json")
+    ]
+    log.info(f"Found courses JSONs: {courses_jsons}")
+
+    # Every semester has the hash, size and modification time of its file, its aggregate,
+    # and the exam links written to it.
+    semesters: Dict[str, Dict[str, Any]] = {}
+    to_summarize: List[str] = []
+
+    for courses_json in courses_jsons:
+        semester = courses_json.removeprefix("courses-").removesuffix(".json")
+        previous = previous_semesters.get(semester)
+        if previous is not None and previous.get("stat") == _get_file_stat(
+            courses_json
+        ):
+            semesters[semester] = previous
+        else:
+            to_summarize.append(semester)
+
+    changed_semesters = set()
+    if len(to_summarize) != 0:
+        log.info(f"Summarizing courses from {to_summarize}")
+        paths = [f"courses-{semester}.json" for semester in to_summarize]
+        previous_hashes = [
+            previous_semesters.get(semester, {}).get("hash")
+            for semester in to_summarize
+        ]
+        if len(to_summarize) == 1:
+            summaries = [summarize_semester(paths[0], previous_hashes[0])]
+        else:
+            with ProcessPoolExecutor(max_workers) as executor:
+                summaries = list(
+                    executor.map(summarize_semester, paths, previous_hashes)
                 )
 
-    for semester, semester_courses in semester_jsons.items():
-        with open(f"courses-{semester}.json", "w") as f:
-            json.dump(semester_courses, f, ensure_ascii=False)
+        for semester, path, summary in zip(to_summarize, paths, summaries):
+            if summary is None:
+                # Only the modification time changed.
+                semesters[semester] = previous_semesters[semester]
+            else:
+                semesters[semester] = summary
+                changed_semesters.add(semester)
+            semesters[semester]["stat"] = _get_file_stat(path)
+
+    log.info(f"{len(changed_semesters)} of {len(semesters)} semesters changed")
+
+    result = merge_aggregates(
+        {semester: info["aggregate"] for semester, info in semesters.items()}
+    )
+    _write_if_changed(output_file, result)
+
+    if os.path.exists("moodle-exams.json"):
+        log.info("Found moodle exams JSON")
+        exams_hash = (
+            _get_file_hash("moodle-exams.json")
+            + str(_get_file_hash("corrections.json"))
+            + ("-auto-correct" if auto_correct else "")
+        )
+
+        if (
+            exams_hash != manifest.get("exams_hash")
+            or len(changed_semesters) != 0
+            or semesters.keys() != previous_semesters.keys()
+        ):
+            with open("moodle-exams.json", "r") as f:
+                moodle_exams = json.load(f)
+
+            corrections = {}
+            if os.path.exists("corrections.json"):
+                log.info("Found corrections JSON")
+                with open("corrections.json", "r") as f:
+                    corrections = json.load(f)
+
+            links, report = match_exam_links(
+                moodle_exams,
+                corrections,
+                {
+                    semester: set(info["aggregate"])
+                    for semester, info in semesters.items()
+                },
+                auto_correct,
+            )
+            with open(match_report_file, "w") as f:
+                json.dump(asdict(report), f, ensure_ascii=False)
+        else:
+            links = manifest.get("links", {})
+
+        for semester, semester_links in links.items():
+            info = semesters[semester]
+            if info["exam_links"] == semester_links:
+                continue
+
+            # Only the semesters being patched are fully loaded, one at a time.
+            courses_json = f"courses-{semester}.json"
+            with open(courses_json, "r") as f:
+                courses = json.load(f)
+
+            for course_id, course in courses.items():
+                course.pop("exam_links", None)
+                if course_id in semester_links:
+                    course["exam_links"] = semester_links[course_id]
+
+            info["hash"] = _write_if_changed(courses_json, courses, info["hash"])
+            info["exam_links"] = semester_links
+            info["stat"] = _get_file_stat(courses_json)
+
+        manifest["exams_hash"] = exams_hash
+        manifest["links"] = links
+
+    manifest["semesters"] = semesters
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, ensure_ascii=False)
 
 
 if __name__ == "__main__":
     setup_logging()
-    main()
+
+    parser = argparse.ArgumentParser(
+        description="Collect the courses and Moodle exams JSONs together"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="reload all of the semester files"
+    )
+    parser.add_argument(
+        "--auto-correct",
+        action="store_true",
+        help="apply the proposed corrections of exam course ids, instead of only reporting them",
+    )
+    args = parser.parse_args()
+
+    main(force=args.force, auto_correct=args.auto_correct)
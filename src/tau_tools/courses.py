@@ -10,14 +10,15 @@ import sys
 import urllib.parse
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import requests
 from bs4 import BeautifulSoup
 
+from tau_tools.instrumentation import instrumentation
 from tau_tools.logging import log, progress, setup_logging
 from tau_tools.prerequisites import get_prerequisites
-from tau_tools.utilities import request
+from tau_tools.utilities import has_markers, request
 
 HEBREW_SEMESTERS = {"a": "א'", "b": "ב'"}
 
@@ -70,6 +71,7 @@ def get_schools() -> List[Tuple[str, List[str]]]:
             "https://www.ims.tau.ac.il/Tal/KR/Search_P.aspx",
             cache_category="courses",
             cache_key="schools",
+            validate=has_markers(r'class="[^"]*\bfreeselect\b'),
         ),
         "html.parser",
     )
@@ -103,17 +105,17 @@ def get_exams(
             "sem": year + semester,
         }
     )
-    result_soup = BeautifulSoup(
-        request(
-            "get",
-            url,
-            s,
-            cache_category="courses",
-            cache_key=f"exam-{course_id.replace('-', '')}-{group}-{year}-{semester}",
-            delay=0.2,
-        ),
-        "html.parser",
+    response_text = request(
+        "get",
+        url,
+        s,
+        cache_category="courses",
+        cache_key=f"exam-{course_id.replace('-', '')}-{group}-{year}-{semester}",
+        delay=0.2,
+        validate=has_markers(r'class="[^"]*\b(tableblds|msgerrs)\b'),
     )
+    with instrumentation.timer("parse"):
+        result_soup = BeautifulSoup(response_text, "html.parser")
 
     if result_soup.select(".msgerrs"):
         # An error ocurred, assume there are no exams
@@ -141,6 +143,11 @@ def get_exams(
 
 
 def parse_result_page(result_soup: BeautifulSoup, year: str) -> List[GroupInfo]:
+    with instrumentation.timer("parse"):
+        return _parse_result_page(result_soup, year)
+
+
+def _parse_result_page(result_soup: BeautifulSoup, year: str) -> List[GroupInfo]:
     all_rows = result_soup.select_one("#frmgrid table[dir=rtl]").select("tr")
     all_rows = all_rows[1:]
     i = 0
@@ -241,6 +248,27 @@ def parse_result_page(result_soup: BeautifulSoup, year: str) -> List[GroupInfo]:
     return courses
 
 
+def _get_search_result_page(
+    s: requests.Session, data: Dict[str, str], cache_key: str
+) -> BeautifulSoup:
+    response_text = request(
+        "post",
+        "https://www.ims.tau.ac.il/Tal/KR/Search_L.aspx",
+        s,
+        data=data,
+        headers={
+            "Accept": "text/html,application/xhtml+xml,application/xml",
+            "Content-Type": "application/x-www-form-urlencoded",
+            "User-Agent": "CourseScrape",
+        },
+        cache_category="courses",
+        cache_key=cache_key,
+        validate=has_markers(r'id="frmgrid"', r'<table[^>]*dir="?rtl'),
+    )
+    with instrumentation.timer("parse"):
+        return BeautifulSoup(response_text, "html.parser")
+
+
 def get_school_courses(
     school_index: int,
     school_details: Tuple[str, List[str]],
@@ -271,21 +299,8 @@ def get_school_courses(
     for option_index, option in enumerate(school_options):
         data = {**payload, school_select: option}
         page_number = 0
-        search_result_page = BeautifulSoup(
-            request(
-                "post",
-                "https://www.ims.tau.ac.il/Tal/KR/Search_L.aspx",
-                s,
-                data=data,
-                headers={
-                    "Accept": "text/html,application/xhtml+xml,application/xml",
-                    "Content-Type": "application/x-www-form-urlencoded",
-                    "User-Agent": "CourseScrape",
-                },
-                cache_category="courses",
-                cache_key=f"courses-{year}-{school_index}-{option_index}-{page_number}",
-            ),
-            "html.parser",
+        search_result_page = _get_search_result_page(
+            s, data, f"courses-{year}-{school_index}-{option_index}-{page_number}"
         )
 
         while len(search_result_page.select("#next")) > 0:
@@ -302,21 +317,8 @@ def get_school_courses(
                 except KeyError:
                     pass
 
-            search_result_page = BeautifulSoup(
-                request(
-                    "post",
-                    "https://www.ims.tau.ac.il/Tal/KR/Search_L.aspx",
-                    s,
-                    data=data,
-                    headers={
-                        "Accept": "text/html,application/xhtml+xml,application/xml",
-                        "Content-Type": "application/x-www-form-urlencoded",
-                        "User-Agent": "CourseScrape",
-                    },
-                    cache_category="courses",
-                    cache_key=f"courses-{year}-{school_index}-{option_index}-{page_number}",
-                ),
-                "html.parser",
+            search_result_page = _get_search_result_page(
+                s, data, f"courses-{year}-{school_index}-{option_index}-{page_number}"
             )
 
         # The final page
@@ -338,7 +340,8 @@ def main(
 ):
     year = str(year)
 
-    schools = get_schools()
+    with instrumentation.timer("schools"):
+        schools = get_schools()
     groups: list[GroupInfo] = []
 
     with progress:
@@ -347,7 +350,9 @@ def main(
         )
         for school_index, school in enumerate(schools):
             progress.update(school_task, advance=1)
-            groups += get_school_courses(school_index, school, year, semesters)
+            with instrumentation.timer("school courses"):
+                groups += get_school_courses(school_index, school, year, semesters)
+            instrumentation.count("schools")
 
     for semester in semesters.value:
         output_file = output_file_template.format(
@@ -392,21 +397,24 @@ def main(
             )
             for course_id in courses:
                 try:
-                    prerequisites = get_prerequisites(
-                        course_id,
-                        courses[course_id]["groups"][0]["group"],
-                        year,
-                        semester,
-                    )
+                    with instrumentation.timer("prerequisites"):
+                        prerequisites = get_prerequisites(
+                            course_id,
+                            courses[course_id]["groups"][0]["group"],
+                            year,
+                            semester,
+                        )
                     courses[course_id]["prerequisites"] = prerequisites
                 except Exception:
                     pass
                 progress.update(prerequisites_task_id, advance=1)
             progress.update(prerequisites_task_id, visible=False)
 
-        with open(output_file, "w") as f:
+        with instrumentation.timer("json write"), open(output_file, "w") as f:
             json.dump(courses, f, ensure_ascii=False)
 
+    instrumentation.report()
+
 
 if __name__ == "__main__":
     setup_logging()
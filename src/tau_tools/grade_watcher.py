@@ -0,0 +1,220 @@
+"""
+Watch the grades of many accounts in IMS and Moodle, and report changes as they are published.
+The last snapshot of every account is stored on disk, and only grades which can still change
+(the academic years which aren't finalized in IMS, the visible courses in Moodle) are fetched.
+"""
+
+import heapq
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from tau_tools.ims import IMS, get_current_year, is_finalized
+from tau_tools.logging import log
+from tau_tools.moodle import Moodle
+
+
+@dataclass
+class WatchedAccount:
+    name: str
+    """A unique name for the account, used for its snapshot file"""
+    ims: Optional[IMS] = None
+    moodle: Optional[Moodle] = None
+    years: Optional[List[int]] = None
+    """
+    The IMS years to watch, in our year format. Finalized years are skipped.
+    By default, the years which aren't finalized yet are worked out on every poll.
+    """
+
+
+@dataclass
+class GradeChange:
+    account: str
+    kind: str
+    """Either `new_grade`, `changed_grade` or `new_feedback`"""
+    source: str
+    """Either `ims` or `moodle`"""
+    key: str
+    """Identifies the grade within the account and source"""
+    old: Optional[Dict[str, Any]]
+    new: Dict[str, Any]
+
+
+def get_unfinalized_years() -> List[int]:
+    """Returns the academic years whose grades may still be published."""
+
+    current_year = get_current_year()
+    return [year for year in [current_year - 1, current_year] if not is_finalized(year)]
+
+
+def diff_grades(
+    account: str,
+    source: str,
+    old: Dict[str, Dict[str, Any]],
+    new: Dict[str, Dict[str, Any]],
+) -> List[GradeChange]:
+    changes = []
+    for key, grade in new.items():
+        previous = old.get(key)
+        if previous is None or previous.get("grade") is None:
+            if grade.get("grade") is not None or grade.get("is_exempt"):
+                changes.append(
+                    GradeChange(account, "new_grade", source, key, previous, grade)
+                )
+        elif previous.get("grade") != grade.get("grade") or previous.get(
+            "is_exempt"
+        ) != grade.get("is_exempt"):
+            changes.append(
+                GradeChange(account, "changed_grade", source, key, previous, grade)
+            )
+
+        if grade.get("feedback") and (
+            previous is None or previous.get("feedback") != grade.get("feedback")
+        ):
+            changes.append(
+                GradeChange(account, "new_feedback", source, key, previous, grade)
+            )
+
+    return changes
+
+
+class GradeWatcher:
+    def __init__(
+        self,
+        accounts: List[WatchedAccount],
+        snapshot_directory="grade-snapshots",
+        interval: float = 600,
+        jitter=0.2,
+        max_workers=4,
+    ):
+        """
+        Polls every account every `interval` seconds, randomized by up to `jitter` of the interval,
+        with up to `max_workers` accounts polled at once.
+        """
+
+        self.accounts = accounts
+        self.snapshot_directory = snapshot_directory
+        self.interval = interval
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self.polling = set()
+        self.lock = threading.Lock()
+
+    def _get_snapshot_file(self, account: WatchedAccount) -> str:
+        return os.path.join(self.snapshot_directory, f"{account.name}.json")
+
+    def load_snapshot(self, account: WatchedAccount) -> Optional[Dict[str, Dict]]:
+        snapshot_file = self._get_snapshot_file(account)
+        if not os.path.exists(snapshot_file):
+            return None
+
+        with open(snapshot_file, "r") as f:
+            return json.load(f)
+
+    def save_snapshot(self, account: WatchedAccount, snapshot: Dict[str, Dict]):
+        os.makedirs(self.snapshot_directory, exist_ok=True)
+        with open(self._get_snapshot_file(account), "w") as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+
+    def fetch_snapshot(self, account: WatchedAccount) -> Dict[str, Dict]:
+        snapshot = {"ims": {}, "moodle": {}}
+
+        if account.ims is not None:
+            if account.years is None:
+                years = get_unfinalized_years()
+            else:
+                years = [year for year in account.years if not is_finalized(year)]
+                if len(years) == 0:
+                    log.warning(
+                        f"All of the IMS years of {account.name} are finalized, so their grades aren't watched"
+                    )
+            if len(years) != 0:
+                for grade in account.ims.get_all_grades(years):
+                    key = f"{grade.study_plan_id}-{grade.semester}-{grade.course_id}"
+                    snapshot["ims"][key] = asdict(grade)
+
+        if account.moodle is not None:
+            courses = account.moodle.get_courses(only_visible=True)
+            with ThreadPoolExecutor(self.max_workers) as executor:
+                course_grades = executor.map(
+                    lambda course: account.moodle.get_grades(course.id), courses
+                )
+                for course, grades in zip(courses, course_grades):
+                    for grade in grades:
+                        key = f"{course.id}-{grade.assignment_id}"
+                        snapshot["moodle"][key] = asdict(grade)
+
+        return snapshot
+
+    def poll_account(self, account: WatchedAccount) -> List[GradeChange]:
+        """
+        Fetches the current grades of the account and returns the changes since the last snapshot.
+        The first poll of an account only stores its snapshot.
+        """
+
+        previous = self.load_snapshot(account)
+        snapshot = self.fetch_snapshot(account)
+
+        changes = []
+        if previous is not None:
+            for source in ["ims", "moodle"]:
+                # Keep grades which weren't fetched this time, e.g. of years which were finalized.
+                snapshot[source] = {**previous.get(source, {}), **snapshot[source]}
+                changes += diff_grades(
+                    account.name, source, previous.get(source, {}), snapshot[source]
+                )
+
+        self.save_snapshot(account, snapshot)
+        return changes
+
+    def _poll_and_notify(
+        self, account: WatchedAccount, callback: Callable[[GradeChange], None]
+    ):
+        try:
+            for change in self.poll_account(account):
+                callback(change)
+        except Exception:
+            log.exception(f"Failed polling the grades of {account.name}")
+        finally:
+            with self.lock:
+                self.polling.discard(account.name)
+
+    def _get_interval(self) -> float:
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(self, callback: Callable[[GradeChange], None], iterations=None):
+        """
+        Polls the accounts forever (or `iterations` times), calling `callback` on every change.
+        The first polls are spread over the first interval, to avoid polling all accounts at once.
+        """
+
+        now = time.monotonic()
+        schedule = [
+            (now + random.uniform(0, self.interval), index, 0)
+            for index in range(len(self.accounts))
+        ]
+        heapq.heapify(schedule)
+
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            while len(schedule) != 0:
+                next_time, index, iteration = heapq.heappop(schedule)
+                time.sleep(max(0, next_time - time.monotonic()))
+
+                account = self.accounts[index]
+                with self.lock:
+                    # Don't poll an account again while it's still being polled.
+                    is_polling = account.name in self.polling
+                    self.polling.add(account.name)
+                if not is_polling:
+                    executor.submit(self._poll_and_notify, account, callback)
+
+                if iterations is None or iteration + 1 < iterations:
+                    heapq.heappush(
+                        schedule,
+                        (next_time + self._get_interval(), index, iteration + 1),
+                    )
@@ -0,0 +1,284 @@
+"""
+A small GraphQL client, which caches the results of operations by their query and variables,
+sends several operations in a single request when the server supports batching, and sends
+hashes instead of full queries when the server supports automatic persisted queries.
+"""
+
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from tau_tools.instrumentation import instrumentation
+from tau_tools.logging import log
+from tau_tools.utilities import (
+    DEFAULT_RETRY_POLICY,
+    InvalidResponseException,
+    RateLimiter,
+    RetryPolicy,
+    read_cache,
+    send,
+    write_cache,
+)
+
+PERSISTED_QUERY_NOT_FOUND = "PersistedQueryNotFound"
+PERSISTED_QUERY_NOT_SUPPORTED = "PersistedQueryNotSupported"
+
+
+class GraphQLException(Exception):
+    def __init__(self, operation_name: str, errors: List[Dict[str, Any]]):
+        Exception.__init__(
+            self,
+            f"{operation_name} failed: "
+            + ", ".join(error.get("message", str(error)) for error in errors),
+        )
+
+        self.errors = errors
+
+
+@dataclass
+class GraphQLOperation:
+    operation_name: str
+    query: str
+    variables: Dict[str, Any] = field(default_factory=dict)
+
+    def get_query_hash(self) -> str:
+        return hashlib.sha256(self.query.encode()).hexdigest()
+
+    def get_cache_key(self) -> str:
+        """A key derived from the query and the normalized variables of the operation."""
+
+        normalized = json.dumps(
+            [self.get_query_hash(), self.variables],
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        return (
+            f"{self.operation_name}-{hashlib.sha256(normalized.encode()).hexdigest()}"
+        )
+
+    def to_json(self, include_query=True, persisted=False) -> Dict[str, Any]:
+        request_json: Dict[str, Any] = {
+            "operationName": self.operation_name,
+            "variables": self.variables,
+        }
+        if include_query:
+            request_json["query"] = self.query
+        if persisted:
+            request_json["extensions"] = {
+                "persistedQuery": {"version": 1, "sha256Hash": self.get_query_hash()}
+            }
+        return request_json
+
+
+def _get_error_codes(result: Dict[str, Any]) -> List[str]:
+    return [
+        error.get("extensions", {}).get("code", error.get("message", ""))
+        for error in result.get("errors") or []
+    ]
+
+
+class GraphQLClient:
+    def __init__(
+        self,
+        api_url: str,
+        rate: float = 1,
+        max_workers=8,
+        batch_size=20,
+        cache_category: Optional[str] = "graphql",
+        retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    ):
+        """
+        Creates a client sending at most `rate` HTTP requests per second to `api_url`.
+        Results are cached under `cache_category`, unless it's `None`.
+        Whether the server supports batching and persisted queries is found out on the first requests.
+        """
+
+        self.api_url = api_url
+        self.rate_limiter = RateLimiter(rate)
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.cache_category = cache_category
+        self.retry_policy = retry_policy
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.supports_batching: Optional[bool] = None
+        self.supports_persisted_queries: Optional[bool] = None
+        self.persisted_queries = set()
+        """Hashes of the queries which were sent to the server along with their hash"""
+
+    def set_rate(self, rate: float):
+        self.rate_limiter = RateLimiter(rate)
+
+    def _post(self, request_json: Any) -> Any:
+        self.rate_limiter.wait()
+        response = send(
+            "post", self.api_url, self.session, self.retry_policy, json=request_json
+        )
+        with instrumentation.timer("parse"):
+            return response.json()
+
+    def _execute_one(self, operation: GraphQLOperation) -> Dict[str, Any]:
+        query_hash = operation.get_query_hash()
+        if self.supports_persisted_queries is False:
+            return self._post(operation.to_json())
+
+        if query_hash in self.persisted_queries:
+            # Until a request with only the hash succeeds, it's unknown whether the server
+            # uses the hash or just ignores it.
+            result = self._post(operation.to_json(include_query=False, persisted=True))
+            error_codes = _get_error_codes(result)
+            if PERSISTED_QUERY_NOT_FOUND in error_codes:
+                # The server forgot the query, so register it again.
+                self.supports_persisted_queries = True
+                return self._post(operation.to_json(persisted=True))
+            if result.get("data") is not None:
+                self.supports_persisted_queries = True
+                return result
+            if (
+                self.supports_persisted_queries
+                and PERSISTED_QUERY_NOT_SUPPORTED not in error_codes
+            ):
+                return result
+
+            log.info(f"{self.api_url} doesn't support persisted queries")
+            self.supports_persisted_queries = False
+            return self._post(operation.to_json())
+
+        # Send the full query along with its hash, registering it for the following requests.
+        result = self._post(operation.to_json(persisted=True))
+        if PERSISTED_QUERY_NOT_SUPPORTED in _get_error_codes(result):
+            log.info(f"{self.api_url} doesn't support persisted queries")
+            self.supports_persisted_queries = False
+            return self._post(operation.to_json())
+
+        if result.get("data") is not None:
+            with self.lock:
+                self.persisted_queries.add(query_hash)
+        return result
+
+    def _execute_batch(
+        self, operations: List[GraphQLOperation]
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Sends the operations in a single request. Returns `None` if the server doesn't support batching,
+        or if the request failed, in which case the operations should be sent on their own.
+        """
+
+        try:
+            results = self._post([operation.to_json() for operation in operations])
+        except requests.HTTPError:
+            # The server rejected the batch.
+            results = None
+        except (requests.RequestException, InvalidResponseException, ValueError) as e:
+            # A failed request doesn't tell whether the server supports batching.
+            log.warning(
+                f"Batch request to {self.api_url} failed ({e}), sending operations on their own"
+            )
+            return None
+
+        if not isinstance(results, list) or len(results) != len(operations):
+            log.info(
+                f"{self.api_url} doesn't support batching, sending operations in parallel"
+            )
+            self.supports_batching = False
+            return None
+
+        self.supports_batching = True
+        return results
+
+    def execute(self, operation: GraphQLOperation, use_cache=True) -> Any:
+        """Executes a single operation and returns its `data`."""
+        return self.execute_many([operation], use_cache)[0]
+
+    def execute_many(
+        self,
+        operations: List[GraphQLOperation],
+        use_cache=True,
+        return_exceptions=False,
+    ) -> List[Any]:
+        """
+        Executes all of the `operations` and returns their `data`, in order.
+        Cached results are used when `use_cache` is set, and the rest are sent in batches.
+        If `return_exceptions` is set, failed operations return their exception instead of raising it.
+        """
+
+        results: List[Any] = [None] * len(operations)
+        missing: List[int] = []
+        for i, operation in enumerate(operations):
+            cached = (
+                read_cache(self.cache_category, operation.get_cache_key())
+                if use_cache and self.cache_category is not None
+                else None
+            )
+            if cached is None:
+                missing.append(i)
+            else:
+                results[i] = json.loads(cached)
+
+        def store_result(i: int, result: Any):
+            if isinstance(result, dict) and result.get("data") is not None:
+                if self.cache_category is not None:
+                    write_cache(
+                        self.cache_category,
+                        operations[i].get_cache_key(),
+                        json.dumps(result["data"], ensure_ascii=False),
+                    )
+                results[i] = result["data"]
+            elif isinstance(result, Exception):
+                results[i] = result
+            else:
+                results[i] = GraphQLException(
+                    operations[i].operation_name, result.get("errors") or [result]
+                )
+
+        def execute_single(i: int):
+            try:
+                store_result(i, self._execute_one(operations[i]))
+            except Exception as e:
+                store_result(i, e)
+
+        def execute_batch(batch: List[int]):
+            batch_results = self._execute_batch([operations[i] for i in batch])
+            if batch_results is None:
+                for i in batch:
+                    execute_single(i)
+                return
+
+            for i, result in zip(batch, batch_results):
+                store_result(i, result)
+
+        batches = [
+            missing[i : i + self.batch_size]
+            for i in range(0, len(missing), self.batch_size)
+        ]
+        if len(missing) > 1 and self.supports_batching is not False:
+            # The first batch finds out whether the server supports batching.
+            first_batch = batches.pop(0)
+            first_results = self._execute_batch([operations[i] for i in first_batch])
+            if first_results is not None:
+                for i, result in zip(first_batch, first_results):
+                    store_result(i, result)
+            else:
+                batches.insert(0, first_batch)
+
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            if self.supports_batching:
+                list(executor.map(execute_batch, batches))
+            else:
+                list(
+                    executor.map(
+                        execute_single, [i for batch in batches for i in batch]
+                    )
+                )
+
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
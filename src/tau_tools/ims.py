@@ -1,13 +1,78 @@
 import datetime
+import html
+import json
+import os
+import re
+import threading
 import time
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, replace
+from typing import Any, Callable, Dict, List, Optional
 from urllib.parse import urlencode
 
 import requests
 from bs4 import BeautifulSoup
 
+from tau_tools.auth import SessionStore, sign_in_to_nidp
+from tau_tools.utilities import DEFAULT_RETRY_POLICY, RetryPolicy, send
+
 IMS_BASE_URL = "https://iims.tau.ac.il"
+IMS_LOGOUT_TITLE = 'אוניברסיטת ת"א - יציאה'
+IMS_TITLE_REGEX = re.compile(r"<title[^>]*>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+
+
+class SessionExpiredException(Exception):
+    def __init__(self):
+        Exception.__init__(self, "IMS returned the logout page")
+
+
+@dataclass
+class AspNetFormState:
+    """The hidden state of an ASP.NET form, which must be posted back with every request."""
+
+    viewstate: str
+    viewstate_generator: str
+    event_validation: str
+
+    @classmethod
+    def from_page(cls, page: BeautifulSoup) -> "AspNetFormState":
+        return cls(
+            page.find("input", {"id": "__VIEWSTATE"})["value"],
+            page.find("input", {"id": "__VIEWSTATEGENERATOR"})["value"],
+            page.find("input", {"id": "__EVENTVALIDATION"})["value"],
+        )
+
+    def to_data(self) -> Dict[str, str]:
+        return {
+            "__VIEWSTATE": self.viewstate,
+            "__VIEWSTATEGENERATOR": self.viewstate_generator,
+            "__EVENTVALIDATION": self.event_validation,
+        }
+
+
+class IMSMetrics:
+    """Counts the page requests of an `IMS` client, and the retries and sign-ins they required."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.sign_ins = 0
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def record_retries(self, retries: int):
+        with self.lock:
+            self.retries += max(0, retries)
+
+    def record_sign_in(self):
+        with self.lock:
+            self.sign_ins += 1
+
+    def __repr__(self):
+        return f"IMSMetrics(requests={self.requests}, retries={self.retries}, sign_ins={self.sign_ins})"
 
 
 @dataclass(unsafe_hash=True)
@@ -28,36 +93,91 @@ class GradeInfo:
     """The study plan ID the course is a part of"""
 
 
+def get_current_year() -> int:
+    """Returns the current academic year, in our year format."""
+
+    today = datetime.date.today()
+    # Academic years start in October.
+    return today.year + 1 if today.month >= 10 else today.year
+
+
+FINALIZATION_GRACE_MONTHS = 6
+"""
+The months after the end of an academic year until its grades are considered final,
+since Moed B, summer semester and appeal grades are still published after it ends.
+"""
+
+
+def is_finalized(year: int, grace_months=FINALIZATION_GRACE_MONTHS) -> bool:
+    """Have all of the grades of the academic year (in our year format) been published?"""
+
+    today = datetime.date.today()
+    # Academic years end in October.
+    months_since_end = (today.year - year) * 12 + today.month - 10
+    return months_since_end >= grace_months
+
+
 class IMS:
-    def __init__(self, username: str, id: str, password: str):
+    def __init__(
+        self,
+        username: str,
+        id: str,
+        password: str,
+        retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+        store: Optional[SessionStore] = None,
+    ):
         self.username = username
         self.id = id
         self.password = password
-        self.session = requests.Session()
+        self.retry_policy = retry_policy
+        self.store = store
+        self.metrics = IMSMetrics()
+        self.session = requests.Session() if store is None else store.session
+        self._state: Optional[Dict[str, Any]] = None
+        self._sign_in_lock = threading.Lock()
 
-        self._sign_in()
+        if store is not None and "ims" in store.clients:
+            # The session is only validated once a page is requested.
+            self._state = store.clients["ims"]
+            return
 
-    def _sign_in(self):
-        self.session = requests.Session()
+        self._sign_in()
 
+    def _authenticate(self) -> Dict[str, Any]:
         # Because of stupid redirection stuff, we need to sign in to the regular stuff before IMS.
-        self.session.get(IMS_BASE_URL + "/Tal/")
-        self.session.post(
-            "https://nidp.tau.ac.il/nidp/saml2/sso?id=10&sid=0&option=credential",
-        )
-        self.session.post(
-            "https://nidp.tau.ac.il/nidp/saml2/sso?sid=0",
-            {
-                "option": "credential",
-                "Ecom_User_ID": self.username,
-                "Ecom_User_Pid": self.id,
-                "Ecom_Password": self.password,
-            },
+        send("get", IMS_BASE_URL + "/Tal/", self.session, self.retry_policy)
+
+        is_signed_in_to_nidp = (
+            self.store is not None and self.store.is_signed_in_to_nidp
         )
-        self.session.get("https://nidp.tau.ac.il/nidp/saml2/sso?sid=0")
+        if not is_signed_in_to_nidp:
+            self._sign_in_to_nidp()
 
-        response = self.session.post(
+        response = self._check_login()
+        if "/Tal/Sys/Main.aspx" not in response.url and is_signed_in_to_nidp:
+            # The stored NIDP session has probably expired.
+            self._sign_in_to_nidp()
+            response = self._check_login()
+
+        if "/Tal/Sys/Main.aspx" not in response.url:
+            raise Exception("Invalid username or password!")
+
+        return {"signed_in_at": time.time()}
+
+    def _sign_in_to_nidp(self):
+        if self.store is not None:
+            self.store.sign_in_to_nidp()
+        else:
+            sign_in_to_nidp(
+                self.session, self.username, self.id, self.password, self.retry_policy
+            )
+
+    def _check_login(self) -> requests.Response:
+        return send(
+            "post",
             IMS_BASE_URL + "/Tal/Login_Chk.aspx",
+            self.session,
+            self.retry_policy,
             data={
                 "txtUser": self.username,
                 "txtId": self.id,
@@ -68,8 +188,24 @@ class IMS:
             },
         )
 
-        if "/Tal/Sys/Main.aspx" not in response.url:
-            raise Exception("Invalid username or password!")
+    def _sign_in(self, stale_state: Optional[Dict[str, Any]] = None):
+        """
+        Signs in again. If the state already changed from `stale_state`, another thread has
+        already signed in, and its session is used instead.
+        """
+
+        if self.store is not None:
+            self._state = self.store.reauthenticate(
+                "ims", stale_state, self._authenticate
+            )
+            return
+
+        with self._sign_in_lock:
+            if self._state is not None and self._state is not stale_state:
+                return
+
+            self.session = requests.Session()
+            self._state = self._authenticate()
 
     def request_page(
         self,
@@ -77,34 +213,60 @@ class IMS:
         path: str,
         params: Dict[str, str],
         data: Optional[Any] = None,
-        attempt_number=1,
         max_attempts=5,
         delay=0.1,
-    ):
+        max_sign_ins=1,
+        refresh_data: Optional[Callable[[], Any]] = None,
+    ) -> BeautifulSoup:
+        """
+        Requests an IMS page, retrying inconsistent responses and signing in again (up to
+        `max_sign_ins` times) when IMS returns its logout page.
+        If the `data` depends on the session (e.g. form state), `refresh_data` is called after
+        signing in to get the data to resend.
+        """
+
         params["id"] = self.id
         params["dt"] = datetime.datetime.now().strftime("%d%m%Y%H%M%S")
 
         url = IMS_BASE_URL + "/Tal/" + path + "?" + urlencode(params)
-        response = self.session.request(method, url, data=data)
-        result = BeautifulSoup(response.text, "html.parser")
-
-        # The system is currently sometimes inconsistent.
-        if attempt_number < 10 and (
-            result.find("title") is None
-            or result.find("title").text == 'אוניברסיטת ת"א - יציאה'
-        ):
-            time.sleep(attempt_number * delay)
-            return self.request_page(
-                method,
-                path,
-                params,
-                data,
-                attempt_number + 1,
-                max_attempts,
-                delay,
-            )
+        retry_policy = replace(
+            self.retry_policy, max_attempts=max_attempts, backoff=delay
+        )
+
+        def is_consistent(response: requests.Response) -> bool:
+            # Only check the title, to avoid parsing pages which are thrown away.
+            match = IMS_TITLE_REGEX.search(response.text)
+            if (
+                match is not None
+                and html.unescape(match[1]).strip() == IMS_LOGOUT_TITLE
+            ):
+                raise SessionExpiredException()
+            # The system is currently sometimes inconsistent.
+            return match is not None
 
-        return result
+        self.metrics.record_request()
+        for sign_in_number in range(max_sign_ins + 1):
+            state = self._state
+            try:
+                response = send(
+                    method,
+                    url,
+                    self.session,
+                    retry_policy,
+                    is_consistent,
+                    lambda error: self.metrics.record_retries(1),
+                    data=data,
+                )
+                return BeautifulSoup(response.text, "html.parser")
+            except SessionExpiredException:
+                if sign_in_number == max_sign_ins:
+                    raise
+                self.metrics.record_sign_in()
+                self._sign_in(state)
+                if refresh_data is not None:
+                    data = refresh_data()
+
+        raise SessionExpiredException()
 
     def get_study_plan_ids(self) -> List[str]:
         page = self.request_page(
@@ -116,9 +278,8 @@ class IMS:
             for input_element in form_element.find_all("input", {"name": "tckey"})
         ]
 
-    def get_grades(self, study_plan_id: str, years: List[int]) -> List[GradeInfo]:
-        results = []
-        first_page = self.request_page(
+    def _get_grades_form_state(self, study_plan_id: str) -> AspNetFormState:
+        page = self.request_page(
             "post",
             "TP/Tziunim_L.aspx",
             params={"src": "", "sys": "tal", "rightmj": 1, "first": "yes", "lang": ""},
@@ -132,66 +293,137 @@ class IMS:
                 "h_eng": "",
             },
         )
+        return AspNetFormState.from_page(page)
 
-        for year in years:
-            page = self.request_page(
-                "post",
-                "TP/Tziunim_L.aspx",
-                params={
-                    "src": "",
-                    "sys": "tal",
-                    "rightmj": 1,
-                    "first": "yes",
-                    "lang": "",
-                },
-                data={
-                    "__VIEWSTATE": first_page.find("input", {"id": "__VIEWSTATE"})[
-                        "value"
-                    ],
-                    "__VIEWSTATEGENERATOR": first_page.find(
-                        "input", {"id": "__VIEWSTATEGENERATOR"}
-                    )["value"],
-                    "__EVENTVALIDATION": first_page.find(
-                        "input", {"id": "__EVENTVALIDATION"}
-                    )["value"],
-                    "lstSem": str(year - 1) + "9",
-                    "old_sem": str(year - 1) + "2",
-                    "peula": "",
-                    "javas": 1,
-                },
-            )
+    def _get_year_grades(
+        self, study_plan_id: str, form_state: AspNetFormState, year: int
+    ) -> List[GradeInfo]:
+        def get_data(form_state: AspNetFormState) -> Dict[str, Any]:
+            return {
+                **form_state.to_data(),
+                "lstSem": str(year - 1) + "9",
+                "old_sem": str(year - 1) + "2",
+                "peula": "",
+                "javas": 1,
+            }
 
-            table = page.find("form").find("table")
-            for row in table.find_all("tr"):
-                cells = row.find_all("td")
-                if len(cells) != 13:
-                    continue
-                cells = [cell.text for cell in cells]
-
-                semester = str(year) + ("a" if cells[0] == "א" else "b")
-                course_id = cells[1].replace("-", "")
-                grade = "".join([c for c in cells[5] if c.isnumeric()])
-                notes = cells[11]
-
-                if grade != "" or notes != "":
-                    results.append(
-                        GradeInfo(
-                            semester,
-                            course_id,
-                            None if grade == "" else int(grade),
-                            "פטור" in notes,
-                            study_plan_id,
-                        )
+        # Every year is requested from the same form state, so the years are independent of each other.
+        # The form state belongs to the session, so a new one is needed after signing in again.
+        page = self.request_page(
+            "post",
+            "TP/Tziunim_L.aspx",
+            params={
+                "src": "",
+                "sys": "tal",
+                "rightmj": 1,
+                "first": "yes",
+                "lang": "",
+            },
+            data=get_data(form_state),
+            refresh_data=lambda: get_data(self._get_grades_form_state(study_plan_id)),
+        )
+
+        results = []
+        table = page.find("form").find("table")
+        for row in table.find_all("tr"):
+            cells = row.find_all("td")
+            if len(cells) != 13:
+                continue
+            cells = [cell.text for cell in cells]
+
+            semester = str(year) + ("a" if cells[0] == "א" else "b")
+            course_id = cells[1].replace("-", "")
+            grade = "".join([c for c in cells[5] if c.isnumeric()])
+            notes = cells[11]
+
+            if grade != "" or notes != "":
+                results.append(
+                    GradeInfo(
+                        semester,
+                        course_id,
+                        None if grade == "" else int(grade),
+                        "פטור" in notes,
+                        study_plan_id,
                     )
+                )
 
         return results
 
-    def get_all_grades(self, years: List[int]) -> List[GradeInfo]:
-        result = set()
+    def get_grades(
+        self, study_plan_id: str, years: List[int], max_workers=4
+    ) -> List[GradeInfo]:
+        form_state = self._get_grades_form_state(study_plan_id)
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            return [
+                grade
+                for year_grades in executor.map(
+                    lambda year: self._get_year_grades(study_plan_id, form_state, year),
+                    years,
+                )
+                for grade in year_grades
+            ]
+
+    def get_all_grades(
+        self,
+        years: List[int],
+        max_workers=4,
+        cache_file: Optional[str] = None,
+        finalization_grace_months=FINALIZATION_GRACE_MONTHS,
+    ) -> List[GradeInfo]:
+        """
+        Fetches the grades of all of the study plans, requesting up to `max_workers` years at once.
+        If `cache_file` is given, the grades of finalized years (which ended at least
+        `finalization_grace_months` months ago) are stored in it and never requested again.
+        """
+
+        cache: Dict[str, List[Dict[str, Any]]] = {}
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                cache = json.load(f)
 
+        result = set()
         study_plan_ids = self.get_study_plan_ids()
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            form_states = {}
+            for study_plan_id in study_plan_ids:
+                missing_years = [
+                    year for year in years if f"{study_plan_id}-{year}" not in cache
+                ]
+                if len(missing_years) != 0:
+                    form_states[study_plan_id] = executor.submit(
+                        self._get_grades_form_state, study_plan_id
+                    )
+
+            year_grades = {}
+            for study_plan_id, form_state in form_states.items():
+                for year in years:
+                    if f"{study_plan_id}-{year}" not in cache:
+                        year_grades[(study_plan_id, year)] = executor.submit(
+                            self._get_year_grades,
+                            study_plan_id,
+                            form_state.result(),
+                            year,
+                        )
+
+            for (study_plan_id, year), grades in year_grades.items():
+                grades = grades.result()
+                result.update(grades)
+                if is_finalized(year, finalization_grace_months):
+                    cache[f"{study_plan_id}-{year}"] = [
+                        asdict(grade) for grade in grades
+                    ]
+
         for study_plan_id in study_plan_ids:
-            study_plan_grades = self.get_grades(study_plan_id, years)
-            result.update(study_plan_grades)
+            for year in years:
+                if f"{study_plan_id}-{year}" in cache:
+                    result.update(
+                        GradeInfo(**grade) for grade in cache[f"{study_plan_id}-{year}"]
+                    )
+
+        if cache_file is not None:
+            with open(cache_file, "w") as f:
+                json.dump(cache, f, ensure_ascii=False)
 
         return list(result)
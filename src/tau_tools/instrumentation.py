@@ -0,0 +1,170 @@
+"""
+Opt-in timers and counters for scraper runs.
+Set `TAU_TOOLS_INSTRUMENT` to enable them, and `TAU_TOOLS_INSTRUMENT_OUTPUT` to a path
+to also export the final report as JSON.
+"""
+
+import heapq
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from rich.table import Table
+
+from tau_tools.logging import console
+
+
+@dataclass
+class StageStatistics:
+    calls: int = 0
+    seconds: float = 0
+    """The time spent in the stage itself, excluding nested stages"""
+
+
+class Instrumentation:
+    def __init__(self, enabled=False, slowest_urls_count=10):
+        self.enabled = enabled
+        self.slowest_urls_count = slowest_urls_count
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.stages: Dict[str, StageStatistics] = {}
+        self.counters: Dict[str, int] = {}
+        self.cache_hits: Dict[str, Tuple[int, int]] = {}
+        self.slowest_urls: List[Tuple[float, str]] = []
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Measure the time spent in `stage`. Time spent in nested timers is attributed to them."""
+
+        if not self.enabled:
+            yield
+            return
+
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        # Every entry is [stage, time spent in nested stages].
+        self.local.stack.append([stage, 0.0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            _, nested_time = self.local.stack.pop()
+            if len(self.local.stack) != 0:
+                self.local.stack[-1][1] += elapsed
+
+            with self.lock:
+                statistics = self.stages.setdefault(stage, StageStatistics())
+                statistics.calls += 1
+                statistics.seconds += elapsed - nested_time
+
+    def count(self, counter: str, amount=1):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def record_cache(self, category: str, hit: bool):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            hits, misses = self.cache_hits.get(category, (0, 0))
+            self.cache_hits[category] = (
+                (hits + 1, misses) if hit else (hits, misses + 1)
+            )
+
+    def record_url(self, url: str, seconds: float):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if len(self.slowest_urls) < self.slowest_urls_count:
+                heapq.heappush(self.slowest_urls, (seconds, url))
+            else:
+                heapq.heappushpop(self.slowest_urls, (seconds, url))
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "stages": {
+                    stage: {"calls": statistics.calls, "seconds": statistics.seconds}
+                    for stage, statistics in self.stages.items()
+                },
+                "counters": dict(self.counters),
+                "cache": {
+                    category: {
+                        "hits": hits,
+                        "misses": misses,
+                        "hit_rate": hits / (hits + misses),
+                    }
+                    for category, (hits, misses) in self.cache_hits.items()
+                },
+                "slowest_urls": [
+                    {"url": url, "seconds": seconds}
+                    for seconds, url in sorted(self.slowest_urls, reverse=True)
+                ],
+            }
+
+    def report(self):
+        """Print the breakdown of the run, and export it if `TAU_TOOLS_INSTRUMENT_OUTPUT` is set."""
+
+        if not self.enabled:
+            return
+
+        result = self.to_dict()
+        total = sum(stage["seconds"] for stage in result["stages"].values())
+
+        stages_table = Table("Stage", "Calls", "Seconds", "%", title="Stages")
+        for stage, statistics in sorted(
+            result["stages"].items(), key=lambda item: -item[1]["seconds"]
+        ):
+            stages_table.add_row(
+                stage,
+                str(statistics["calls"]),
+                f"{statistics['seconds']:.2f}",
+                f"{100 * statistics['seconds'] / total:.1f}" if total != 0 else "-",
+            )
+        console.print(stages_table)
+
+        if len(result["cache"]) != 0:
+            cache_table = Table("Category", "Hits", "Misses", "Hit rate", title="Cache")
+            for category, statistics in result["cache"].items():
+                cache_table.add_row(
+                    category,
+                    str(statistics["hits"]),
+                    str(statistics["misses"]),
+                    f"{100 * statistics['hit_rate']:.1f}%",
+                )
+            console.print(cache_table)
+
+        if len(result["counters"]) != 0:
+            counters_table = Table("Counter", "Value", title="Counters")
+            for counter, value in result["counters"].items():
+                counters_table.add_row(counter, str(value))
+            console.print(counters_table)
+
+        if len(result["slowest_urls"]) != 0:
+            urls_table = Table("URL", "Seconds", title="Slowest URLs")
+            for url in result["slowest_urls"]:
+                urls_table.add_row(url["url"], f"{url['seconds']:.2f}")
+            console.print(urls_table)
+
+        output_file = os.environ.get("TAU_TOOLS_INSTRUMENT_OUTPUT", "")
+        if output_file != "":
+            with open(output_file, "w") as f:
+                json.dump(result, f)
+
+
+instrumentation = Instrumentation(
+    enabled="TAU_TOOLS_INSTRUMENT" in os.environ
+    and len(os.environ["TAU_TOOLS_INSTRUMENT"]) != 0
+)
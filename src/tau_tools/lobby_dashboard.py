@@ -3,11 +3,18 @@ Get information about exams happening today at Tel Aviv University.
 Inspired by the dashboard at https://lobbydashboard.tau.ac.il/exact-sciences/monitors/%D7%9C%D7%95%D7%97-%D7%91%D7%97%D7%99%D7%A0%D7%95%D7%AA-%D7%99%D7%95%D7%9E%D7%99-%D7%94%D7%A4%D7%A7%D7%95%D7%9C%D7%98%D7%94-%D7%9C%D7%9E%D7%93%D7%A2%D7%99%D7%9D-%D7%9E%D7%93%D7%95%D7%99%D7%A7%D7%99/
 """
 
-from dataclasses import dataclass
+import argparse
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
 
-import requests
-
-from tau_tools.logging import console, setup_logging
+from tau_tools.logging import console, log, setup_logging
+from tau_tools.utilities import send
 
 
 @dataclass
@@ -28,7 +35,8 @@ class ExamInfo:
 
 
 def get_exam_info(post_id=68, site_id=7):
-    response = requests.post(
+    response = send(
+        "post",
         "https://lobbydashboard.tau.ac.il/evg-ajax/",
         data={"act": "get_app", "post_id": post_id, "site_id": site_id},
     )
@@ -53,7 +61,285 @@ def get_exam_info(post_id=68, site_id=7):
     ]
 
 
+@dataclass
+class Dashboard:
+    name: str
+    """The name the dashboard is served under"""
+    post_id: int = 68
+    site_id: int = 7
+
+
+@dataclass
+class DashboardSnapshot:
+    exams: List[ExamInfo]
+    version: int
+    """Incremented whenever the exams change"""
+    updated_at: float
+    """The UNIX timestamp of the last change"""
+    hash: str
+    """The hash of the exams, which unlike `version` is stable across restarts"""
+
+    def to_json(self) -> bytes:
+        return json.dumps(
+            {
+                "version": self.version,
+                "updated_at": self.updated_at,
+                "exams": [asdict(exam) for exam in self.exams],
+            },
+            ensure_ascii=False,
+        ).encode()
+
+
+def _hash_exams(exams: List[ExamInfo]) -> str:
+    return hashlib.sha256(
+        json.dumps(
+            [asdict(exam) for exam in exams], sort_keys=True, ensure_ascii=False
+        ).encode()
+    ).hexdigest()
+
+
+class DashboardPoller:
+    """
+    Polls several dashboards concurrently every `interval` seconds, keeping the last snapshot of every one,
+    so that many screens can be served without each of them requesting the dashboards.
+    """
+
+    def __init__(
+        self, dashboards: List[Dashboard], interval: float = 60, max_workers=4
+    ):
+        self.dashboards = {dashboard.name: dashboard for dashboard in dashboards}
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.snapshots: Dict[str, DashboardSnapshot] = {}
+        self.changed = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def poll(self) -> List[str]:
+        """Fetches all of the dashboards, and returns the names of the ones which changed."""
+
+        def fetch(dashboard: Dashboard) -> Optional[List[ExamInfo]]:
+            try:
+                return get_exam_info(dashboard.post_id, dashboard.site_id)
+            except Exception as e:
+                log.warning(f"Failed fetching the {dashboard.name} dashboard: {e}")
+                return None
+
+        dashboards = list(self.dashboards.values())
+        changed = []
+        for dashboard, exams in zip(dashboards, self.executor.map(fetch, dashboards)):
+            if exams is None:
+                continue
+
+            with self.changed:
+                previous = self.snapshots.get(dashboard.name)
+                if previous is not None and previous.exams == exams:
+                    continue
+                self.snapshots[dashboard.name] = DashboardSnapshot(
+                    exams,
+                    previous.version + 1 if previous is not None else 1,
+                    time.time(),
+                    _hash_exams(exams),
+                )
+            changed.append(dashboard.name)
+
+        if len(changed) != 0:
+            log.info(f"Dashboards changed: {changed}")
+            with self.changed:
+                self.changed.notify_all()
+        return changed
+
+    def get_snapshot(self, name: str) -> Optional[DashboardSnapshot]:
+        with self.changed:
+            return self.snapshots.get(name)
+
+    def wait_for_change(
+        self, name: str, version: int, timeout: float
+    ) -> Optional[DashboardSnapshot]:
+        """Waits until the dashboard is newer than `version`, and returns it, or `None` on timeout."""
+
+        with self.changed:
+            self.changed.wait_for(
+                lambda: self.stopped.is_set()
+                or (name in self.snapshots and self.snapshots[name].version > version),
+                timeout,
+            )
+            snapshot = self.snapshots.get(name)
+            if snapshot is None or snapshot.version <= version:
+                return None
+            return snapshot
+
+    def run(self):
+        """Polls the dashboards until `stop` is called."""
+
+        while not self.stopped.is_set():
+            self.poll()
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        """Runs the poller in a background thread."""
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.changed:
+            self.changed.notify_all()
+        # Let an ongoing poll finish before shutting down the executor it submits to.
+        if self.thread is not None:
+            self.thread.join()
+        self.executor.shutdown()
+
+
+def create_server(
+    poller: DashboardPoller, host="127.0.0.1", port=8080, heartbeat: float = 15
+) -> ThreadingHTTPServer:
+    """
+    Creates a server of the snapshots of the `poller`:
+    - `GET /dashboards` returns the names and versions of the dashboards.
+    - `GET /dashboards/<name>` returns the exams of the dashboard, and supports `If-None-Match`.
+    - `GET /dashboards/<name>/events` is a stream of server-sent events, with the exams of the
+      dashboard whenever they change.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+        def _send_json(self, body: bytes, status=200, headers: Dict[str, str] = {}):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _parse_path(self) -> Tuple[Optional[str], bool]:
+            parts = [part for part in self.path.split("?")[0].split("/") if part != ""]
+            if len(parts) == 2 and parts[0] == "dashboards":
+                return parts[1], False
+            if len(parts) == 3 and parts[0] == "dashboards" and parts[2] == "events":
+                return parts[1], True
+            return None, False
+
+        def do_GET(self):
+            if self.path.split("?")[0].rstrip("/") == "/dashboards":
+                self._send_json(
+                    json.dumps(
+                        {
+                            name: snapshot.version
+                            for name, snapshot in poller.snapshots.copy().items()
+                        }
+                    ).encode()
+                )
+                return
+
+            name, is_events = self._parse_path()
+            if name is None or name not in poller.dashboards:
+                self._send_json(b'{"error": "not found"}', 404)
+                return
+
+            if is_events:
+                self._stream_events(name)
+                return
+
+            snapshot = poller.get_snapshot(name)
+            if snapshot is None:
+                self._send_json(b'{"error": "not fetched yet"}', 503)
+                return
+
+            etag = f'"{snapshot.hash}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self._send_json(snapshot.to_json(), headers={"ETag": etag})
+
+        def _stream_events(self, name: str):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+
+            version = 0
+            snapshot = poller.get_snapshot(name)
+            try:
+                while not poller.stopped.is_set():
+                    if snapshot is not None and snapshot.version > version:
+                        version = snapshot.version
+                        self.wfile.write(
+                            f"id: {version}\ndata: ".encode()
+                            + snapshot.to_json()
+                            + b"\n\n"
+                        )
+                    else:
+                        # Keep the connection alive.
+                        self.wfile.write(b": heartbeat\n\n")
+                    self.wfile.flush()
+                    snapshot = poller.wait_for_change(name, version, heartbeat)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve(
+    dashboards: List[Dashboard], interval: float = 60, host="127.0.0.1", port=8080
+):
+    """Polls the `dashboards` and serves them until interrupted."""
+
+    poller = DashboardPoller(dashboards, interval)
+    server = create_server(poller, host, port)
+    poller.start()
+    log.info(f"Serving {len(dashboards)} dashboards on http://{host}:{port}/dashboards")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        poller.stop()
+        server.server_close()
+
+
+def _parse_dashboard(value: str) -> Dashboard:
+    """Parses a dashboard in the format `name:post_id:site_id`."""
+
+    name, post_id, site_id = value.split(":")
+    return Dashboard(name, int(post_id), int(site_id))
+
+
 if __name__ == "__main__":
     setup_logging()
 
-    console.print(get_exam_info())
+    parser = argparse.ArgumentParser(
+        description="Get today's exams from the lobby dashboards"
+    )
+    parser.add_argument(
+        "--dashboard",
+        type=_parse_dashboard,
+        action="append",
+        help="a dashboard to poll, in the format name:post_id:site_id (repeatable)",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="poll the dashboards and serve them over HTTP",
+    )
+    parser.add_argument("--interval", type=float, default=60)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    dashboards = args.dashboard or [Dashboard("exact-sciences")]
+    if args.serve:
+        serve(dashboards, args.interval, args.host, args.port)
+    else:
+        for dashboard in dashboards:
+            console.print(get_exam_info(dashboard.post_id, dashboard.site_id))
@@ -1,15 +1,29 @@
+import asyncio
 import json
 import os
 import re
-from dataclasses import dataclass
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from datetime import datetime
-from typing import List, Optional, Union
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from requests.utils import cookiejar_from_dict, dict_from_cookiejar
 
-from tau_tools.utilities import try_float, try_int
+from tau_tools.auth import SessionStore, sign_in_to_nidp
+from tau_tools.utilities import (
+    DEFAULT_RETRY_POLICY,
+    InvalidResponseException,
+    RetryPolicy,
+    send,
+    try_float,
+    try_int,
+)
 
 
 @dataclass
@@ -28,6 +42,7 @@ class AssignmentInfo:
     course_name: str
     due_date: datetime
     is_overdue: bool
+    time_modified: Optional[datetime] = None
 
 
 @dataclass
@@ -40,13 +55,71 @@ class AttachmentInfo:
 class AdditionalAssignmentInfo:
     attachments: List[AttachmentInfo]
     description: str
-    grade: Optional[int]
+    grade: Optional[Union[float, str]]
     grade_date: Optional[datetime]
     checker: Optional[str]
+    """The name of the grader"""
     feedback_comments: Optional[str]
+    """The HTML of the feedback comments"""
     feedback_files: Optional[List[AttachmentInfo]]
 
 
+FEEDBACK_LABELS = {
+    "grade_date": ["graded on", "נבדק בתאריך", "תאריך מתן ציון", "תאריך ציון"],
+    "checker": ["graded by", "נבדק על ידי", "נבדק ע", "בודק"],
+    "feedback_comments": ["feedback comments", "הערות משוב", "הערות"],
+    "feedback_files": ["feedback files", "קבצי משוב"],
+    "grade": ["grade", "ציון"],
+}
+"""Labels of the rows in the feedback table, in both English and Hebrew"""
+
+ENGLISH_MONTHS = [
+    "january",
+    "february",
+    "march",
+    "april",
+    "may",
+    "june",
+    "july",
+    "august",
+    "september",
+    "october",
+    "november",
+    "december",
+]
+HEBREW_MONTHS = [
+    "ינואר",
+    "פברואר",
+    "מרץ",
+    "אפריל",
+    "מאי",
+    "יוני",
+    "יולי",
+    "אוגוסט",
+    "ספטמבר",
+    "אוקטובר",
+    "נובמבר",
+    "דצמבר",
+]
+MONTHS = {
+    **{month: index + 1 for index, month in enumerate(ENGLISH_MONTHS)},
+    **{month: index + 1 for index, month in enumerate(HEBREW_MONTHS)},
+}
+DATE_REGEX = re.compile(r"(\d{1,2}) (\S+) (\d{4}),? (\d{1,2}):(\d{2})(?: ?(AM|PM))?")
+
+
+def _parse_date(text: str) -> Optional[datetime]:
+    """Parses Moodle dates such as `Monday, 1 May 2023, 10:00 AM`, in English or Hebrew."""
+
+    match = DATE_REGEX.search(text)
+    if match is None or match.group(2).lower() not in MONTHS:
+        return None
+
+    day, month, year, hour, minute, period = match.groups()
+    hour = int(hour) % 12 + (12 if period == "PM" else 0) if period else int(hour)
+    return datetime(int(year), MONTHS[month.lower()], int(day), hour, int(minute))
+
+
 @dataclass
 class GradeInfo:
     assignment_id: int
@@ -77,6 +150,68 @@ class MoodleException(Exception):
         self.more_info_url = more_info_url
 
 
+def _is_json(response: requests.Response) -> bool:
+    try:
+        response.json()
+        return True
+    except ValueError:
+        return False
+
+
+@dataclass
+class ServiceCall:
+    methodname: str
+    args: Dict[str, Any]
+    parse: Optional[Callable[[Any], Any]] = None
+    """Converts the returned data to the result of the call"""
+    data: Any = None
+    error: Optional[MoodleException] = None
+
+    def result(self):
+        """Returns the parsed data of the call, or raises its error."""
+
+        if self.error is not None:
+            raise self.error
+        return self.data if self.parse is None else self.parse(self.data)
+
+
+def _parse_courses(only_visible: bool, data) -> List[CourseInfo]:
+    return [
+        CourseInfo(info["id"], info["fullname"], info["hidden"], info["isfavourite"])
+        for info in data["courses"]
+        if not only_visible or info["visible"]
+    ]
+
+
+def _parse_assignments(data) -> List[AssignmentInfo]:
+    return [
+        AssignmentInfo(
+            info["instance"],
+            info["name"],
+            info["course"]["id"],
+            info["course"]["fullname"],
+            datetime.fromtimestamp(info["timesort"]),
+            info["overdue"],
+            (
+                datetime.fromtimestamp(info["timemodified"])
+                if "timemodified" in info
+                else None
+            ),
+        )
+        for info in data["events"]
+    ]
+
+
+def _get_range_validator(response: requests.Response) -> Optional[str]:
+    """Returns the value to send in `If-Range` to resume the download, if there is one."""
+
+    etag = response.headers.get("ETag")
+    # Weak ETags can't be used in `If-Range`.
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
 class Moodle:
     SAML_RESPONSE_REGEX = re.compile(r'name="SAMLResponse" value="(.*?)"')
     SESSKEY_REGEX = re.compile(
@@ -86,17 +221,47 @@ class Moodle:
         r'"https:\/\/moodle\.tau\.ac\.il\/user\/profile\.php\?id=(.*?)"'
     )
 
+    ADDITIONAL_INFO_CACHE_TTL = 600
+    """
+    The seconds the additional info of an assignment is cached for. Posting a grade or feedback
+    doesn't change the modification time of the assignment, so the cache has to expire.
+    """
+    ADDITIONAL_INFO_CACHE_SIZE = 1000
+
     sesskey: str
     user_id: int
 
     def __init__(
-        self, username: str, id: str, password: str, session_file: Optional[str] = None
+        self,
+        username: str,
+        id: str,
+        password: str,
+        session_file: Optional[str] = None,
+        retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+        max_connections=10,
+        store: Optional[SessionStore] = None,
     ):
         self.username = username
         self.id = id
         self.password = password
-        self.session = requests.Session()
         self.session_file = session_file
+        self.retry_policy = retry_policy
+        self.max_connections = max_connections
+        self.store = store
+        self.session = self._create_session() if store is None else store.session
+        self._state: Optional[Dict[str, Any]] = None
+        self._additional_info_cache: Dict[
+            int, Tuple[Any, float, AdditionalAssignmentInfo]
+        ] = {}
+        """The modification time, fetch time and additional info of assignments, by their ID"""
+        self._additional_info_cache_lock = threading.Lock()
+
+        if store is not None:
+            if "moodle" in store.clients:
+                self._apply_state(store.clients["moodle"])
+            else:
+                self._sign_in()
+            return
 
         if session_file is not None and os.path.exists(session_file):
             with open(session_file, "r") as f:
@@ -114,32 +279,56 @@ class Moodle:
 
         self._sign_in()
 
-    def _sign_in(self):
-        self.session = requests.Session()
-        self.session.get("https://moodle.tau.ac.il/login/index.php")
-        self.session.post(
-            "https://nidp.tau.ac.il/nidp/saml2/sso?id=10&sid=0&option=credential"
-        )
-        self.session.post(
-            "https://nidp.tau.ac.il/nidp/saml2/sso?sid=0",
-            {
-                "option": "credential",
-                "Ecom_User_ID": self.username,
-                "Ecom_User_Pid": self.id,
-                "Ecom_Password": self.password,
-            },
-        )
-        response = self.session.get("https://nidp.tau.ac.il/nidp/saml2/sso?sid=0")
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        # Allow the session to be shared between concurrent requests without discarding connections.
+        session.mount("https://", HTTPAdapter(pool_maxsize=self.max_connections))
+        return session
+
+    def _apply_state(self, state: Dict[str, Any]):
+        self._state = state
+        self.sesskey = state["sesskey"]
+        self.user_id = state["user_id"]
+
+    def _authenticate(self) -> Dict[str, Any]:
+        response = self._send("get", "https://moodle.tau.ac.il/login/index.php")
+        # If the NIDP session is still valid, NIDP redirects back with the SAML response right away.
+        if Moodle.SAML_RESPONSE_REGEX.search(response.text) is None:
+            response = (
+                self.store.sign_in_to_nidp()
+                if self.store is not None
+                else sign_in_to_nidp(
+                    self.session,
+                    self.username,
+                    self.id,
+                    self.password,
+                    self.retry_policy,
+                )
+            )
         saml_response = Moodle.SAML_RESPONSE_REGEX.findall(response.text)[0]
-        response = self.session.post(
+        response = self._send(
+            "post",
             "https://moodle.tau.ac.il/auth/saml2/sp/saml2-acs.php/moodle.tau.ac.il",
-            {
+            data={
                 "SAMLResponse": saml_response,
                 "RelayState": "https://moodle.tau.ac.il/login/index.php",
             },
         )
-        self.sesskey = Moodle.SESSKEY_REGEX.findall(response.text)[0]
-        self.user_id = int(Moodle.USER_ID_REGEX.findall(response.text)[0])
+
+        return {
+            "sesskey": Moodle.SESSKEY_REGEX.findall(response.text)[0],
+            "user_id": int(Moodle.USER_ID_REGEX.findall(response.text)[0]),
+        }
+
+    def _sign_in(self):
+        if self.store is not None:
+            self._apply_state(
+                self.store.reauthenticate("moodle", self._state, self._authenticate)
+            )
+            return
+
+        self.session = self._create_session()
+        self._apply_state(self._authenticate())
 
         if self.session_file is not None:
             with open(self.session_file, "w") as f:
@@ -152,27 +341,93 @@ class Moodle:
                     f,
                 )
 
-    def request_service(self, service_name: str, payload):
-        result = self.session.post(
-            f"https://moodle.tau.ac.il/lib/ajax/service.php?&sesskey={self.sesskey}&info={service_name}",
-            json=payload,
-        ).json()[0]
+    def _send(self, method: str, url: str, validate=None, **kwargs):
+        return send(method, url, self.session, self.retry_policy, validate, **kwargs)
+
+    def batch(self) -> "MoodleBatch":
+        """Create a batch of service calls, to be sent in a single request."""
+        return MoodleBatch(self)
+
+    def request_services(self, calls: List["ServiceCall"], sign_in_again=True):
+        """
+        Send all of the `calls` in a single request, setting their `data` or `error`.
+        Moodle stops processing the calls after the first failing one.
+        If the session has expired, signs in again and resends the calls, unless `sign_in_again` is unset.
+        """
+
+        response = self._send(
+            "post",
+            f"https://moodle.tau.ac.il/lib/ajax/service.php?&sesskey={self.sesskey}&info={','.join(call.methodname for call in calls)}",
+            _is_json,
+            json=[
+                {"index": index, "methodname": call.methodname, "args": call.args}
+                for index, call in enumerate(calls)
+            ],
+        ).json()
+
+        for index, call in enumerate(calls):
+            if index >= len(response):
+                call.error = MoodleException(
+                    "notprocessed",
+                    "The call wasn't processed because a previous call failed",
+                    "",
+                    "",
+                )
+                continue
 
-        if "error" in result and result["error"]:
-            exception = result["exception"]
+            result = response[index]
+            if "error" in result and result["error"]:
+                exception = result["exception"]
 
-            if exception["errorcode"] == "servicerequireslogin":
-                self._sign_in()
-                return self.request_service(service_name, payload)
+                if exception["errorcode"] == "servicerequireslogin" and sign_in_again:
+                    self._sign_in()
+                    return self.request_services(calls, sign_in_again=False)
 
-            raise MoodleException(
-                exception["errorcode"],
-                exception["message"],
-                exception["link"],
-                exception["moreinfourl"],
+                call.error = MoodleException(
+                    exception["errorcode"],
+                    exception["message"],
+                    exception["link"],
+                    exception["moreinfourl"],
+                )
+            else:
+                call.data = result["data"]
+
+    def is_session_valid(self) -> bool:
+        """Checks whether the session is still signed in, using a single cheap request."""
+
+        try:
+            response = send(
+                "post",
+                f"https://moodle.tau.ac.il/lib/ajax/service.php?&sesskey={self.sesskey}&info=core_session_touch",
+                self.session,
+                replace(self.retry_policy, max_attempts=1),
+                json=[{"index": 0, "methodname": "core_session_touch", "args": {}}],
             )
+            result = response.json()[0]
+        except (
+            requests.RequestException,
+            InvalidResponseException,
+            ValueError,
+            LookupError,
+        ):
+            # An expired session gets the login page, which isn't worth retrying.
+            return False
+
+        return not (
+            result.get("error")
+            and result["exception"]["errorcode"] == "servicerequireslogin"
+        )
 
-        return result["data"]
+    def ensure_signed_in(self):
+        """Signs in again if the session (e.g. one loaded from `session_file`) has expired."""
+
+        if not self.is_session_valid():
+            self._sign_in()
+
+    def request_service(self, service_name: str, payload):
+        calls = [ServiceCall(call["methodname"], call["args"]) for call in payload]
+        self.request_services(calls)
+        return calls[0].result()
 
     def get_page(
         self, page_id: Optional[str] = None, page_url: Optional[str] = None
@@ -183,75 +438,73 @@ class Moodle:
             )
         if page_url is None:
             page_url = f"https://moodle.tau.ac.il/course/view.php?id={page_id}"
-        result = self.session.get(page_url)
+        result = self._send("get", page_url)
         return BeautifulSoup(result.text, "html.parser")
 
     def get_courses(self, only_visible=True) -> List[CourseInfo]:
-        response = self.request_service(
-            "block_mycourses_get_enrolled_courses_by_timeline_classification",
-            [
-                {
-                    "index": 0,
-                    "methodname": "block_mycourses_get_enrolled_courses_by_timeline_classification",
-                    "args": {
-                        "offset": 0,
-                        "limit": 0,
-                        "classification": "all",
-                        "sort": "fullname",
-                        "customfieldname": "",
-                        "customfieldvalue": "",
-                        "groupmetacourses": 1,
-                    },
-                }
-            ],
-        )
-
-        return [
-            CourseInfo(
-                info["id"], info["fullname"], info["hidden"], info["isfavourite"]
-            )
-            for info in response["courses"]
-            if not only_visible or info["visible"]
-        ]
+        batch = self.batch()
+        courses = batch.get_courses(only_visible)
+        batch.send()
+        return courses.result()
 
     def get_assignments(
         self, limit=50, since=0, until=100000000000
     ) -> List[AssignmentInfo]:
-        # TODO: understand the limittononsuspendedevents argument
-        response = self.request_service(
-            "block_timeline_extra_local_get_action_events_by_timesort",
-            [
-                {
-                    "index": 0,
-                    "methodname": "block_timeline_extra_local_get_action_events_by_timesort",
-                    "args": {
-                        "limitnum": limit,
-                        "timesortfrom": since,
-                        "timesortto": until,
-                        "limittononsuspendedevents": True,
-                    },
-                }
-            ],
-        )
-
-        return [
-            AssignmentInfo(
-                info["instance"],
-                info["name"],
-                info["course"]["id"],
-                info["course"]["fullname"],
-                datetime.fromtimestamp(info["timesort"]),
-                info["overdue"],
-            )
-            for info in response["events"]
-        ]
+        batch = self.batch()
+        assignments = batch.get_assignments(limit, since, until)
+        batch.send()
+        return assignments.result()
 
-    def get_additional_info(self, assignment_id: int):
-        # TODO: parse for grade, grade_date, checker, feedback_comments and feedback_files. Note that a lot of different subsets of these optionals are possible.
+    def _get_assignments_page(
+        self, limit: int, since: int, until: int, after_event_id: Optional[int]
+    ):
+        batch = self.batch()
+        assignments = batch.get_assignments(limit, since, until, after_event_id)
+        batch.send()
+        assignments.result()
+        return assignments.data
+
+    def iter_assignments(
+        self, page_size=50, since=0, until=100000000000, prefetch=False
+    ) -> Iterator[AssignmentInfo]:
+        """
+        Lazily yields all of the assignments between `since` and `until`, `page_size` at a time.
+        If `prefetch` is set, the next page is fetched while the current one is being consumed.
+        """
+
+        with ThreadPoolExecutor(1) as executor:
+            page = self._get_assignments_page(page_size, since, until, None)
+            while True:
+                events = page["events"]
+                has_next_page = len(events) == page_size
+                if has_next_page:
+                    after_event_id = page.get("lastid", events[-1]["id"])
+                    if prefetch:
+                        next_page = executor.submit(
+                            self._get_assignments_page,
+                            page_size,
+                            since,
+                            until,
+                            after_event_id,
+                        )
+
+                yield from _parse_assignments(page)
+
+                if not has_next_page:
+                    return
+                page = (
+                    next_page.result()
+                    if prefetch
+                    else self._get_assignments_page(
+                        page_size, since, until, after_event_id
+                    )
+                )
 
+    def get_additional_info(self, assignment_id: int) -> AdditionalAssignmentInfo:
         page = BeautifulSoup(
-            self.session.get(
-                f"https://moodle.tau.ac.il/mod/assign/view.php?id={assignment_id}"
+            self._send(
+                "get",
+                f"https://moodle.tau.ac.il/mod/assign/view.php?id={assignment_id}",
             ).text,
             "html.parser",
         )
@@ -264,24 +517,241 @@ class Moodle:
 
         description = page.find("div", {"class": "activity-description"})
 
+        # Note that a lot of different subsets of the feedback rows are possible.
+        feedback = {}
+        feedback_element = page.find("div", {"class": "feedback"})
+        if feedback_element is not None:
+            for row in feedback_element.find_all("tr"):
+                th, td = row.find("th"), row.find("td")
+                if th is None or td is None:
+                    continue
+                for field, labels in FEEDBACK_LABELS.items():
+                    if any(label in th.text.strip().lower() for label in labels):
+                        feedback.setdefault(field, td)
+                        break
+
+        grade = None
+        if "grade" in feedback:
+            grade_text = feedback["grade"].text.strip().split("/")[0].strip()
+            grade = None if grade_text in ["", "-"] else try_float(grade_text)
+
+        feedback_files = None
+        if "feedback_files" in feedback:
+            feedback_files = [
+                AttachmentInfo(a.text.strip(), a["href"])
+                for a in feedback["feedback_files"].find_all("a")
+                if "href" in a.attrs and "assignfeedback_file" in a["href"]
+            ]
+
         return AdditionalAssignmentInfo(
             attachments,
-            str(description) if description.text.strip() != "" else "",
-            None,
-            None,
-            None,
-            None,
-            None,
+            (
+                str(description)
+                if description is not None and description.text.strip() != ""
+                else ""
+            ),
+            grade,
+            (
+                _parse_date(feedback["grade_date"].text)
+                if "grade_date" in feedback
+                else None
+            ),
+            feedback["checker"].text.strip() if "checker" in feedback else None,
+            (
+                feedback["feedback_comments"].decode_contents().strip()
+                if "feedback_comments" in feedback
+                else None
+            ),
+            feedback_files,
         )
 
+    def get_additional_info_many(
+        self,
+        assignment_ids: List[int],
+        modification_times: Optional[Dict[int, Any]] = None,
+        max_workers=8,
+    ) -> Dict[int, AdditionalAssignmentInfo]:
+        """
+        Concurrently fetches the additional info of many assignments, keyed by the assignment ID.
+        Assignments with a known modification time in `modification_times` are cached until their
+        modification time changes, for at most `ADDITIONAL_INFO_CACHE_TTL` seconds.
+        """
+
+        if modification_times is None:
+            modification_times = {}
+
+        def get_cached_additional_info(assignment_id: int):
+            modification_time = modification_times.get(assignment_id)
+            with self._additional_info_cache_lock:
+                cached = self._additional_info_cache.get(assignment_id)
+            if (
+                modification_time is not None
+                and cached is not None
+                and cached[0] == modification_time
+                and time.monotonic() - cached[1] < self.ADDITIONAL_INFO_CACHE_TTL
+            ):
+                return cached[2]
+
+            additional_info = self.get_additional_info(assignment_id)
+            if modification_time is not None:
+                with self._additional_info_cache_lock:
+                    # Keep the cache ordered from the least recently fetched.
+                    self._additional_info_cache.pop(assignment_id, None)
+                    self._additional_info_cache[assignment_id] = (
+                        modification_time,
+                        time.monotonic(),
+                        additional_info,
+                    )
+                    while (
+                        len(self._additional_info_cache)
+                        > self.ADDITIONAL_INFO_CACHE_SIZE
+                    ):
+                        del self._additional_info_cache[
+                            next(iter(self._additional_info_cache))
+                        ]
+            return additional_info
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            return dict(
+                zip(
+                    assignment_ids,
+                    executor.map(get_cached_additional_info, assignment_ids),
+                )
+            )
+
     def download_url(self, url: str):
-        response = self.session.get(url)
+        response = self._send("get", url)
         return response.content
 
+    def download(self, url: str, path: str, chunk_size=1 << 20, resume=True) -> str:
+        """
+        Streams `url` to `path` in chunks, resuming a previous partial download if `resume` is set
+        and the file didn't change on the server since.
+        The size of the file is verified against the size reported by the server.
+        Returns the `path`.
+        """
+
+        partial_path = path + ".part"
+        # The ETag or Last-Modified of the file the partial download was started from.
+        validator_path = partial_path + ".validator"
+        offset = 0
+        headers = {}
+        if resume and os.path.exists(partial_path) and os.path.exists(validator_path):
+            with open(validator_path, "r") as f:
+                validator = f.read()
+            offset = os.path.getsize(partial_path)
+            if offset != 0:
+                headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        try:
+            response = self._send("get", url, stream=True, headers=headers)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 416:
+                raise
+
+            content_range = e.response.headers.get("Content-Range", "")
+            if content_range.split("/")[-1] == str(offset):
+                # The partial download is already complete.
+                os.replace(partial_path, path)
+                os.remove(validator_path)
+                return path
+
+            # The partial download doesn't match the file on the server, start over.
+            return self.download(url, path, chunk_size, resume=False)
+
+        expected_size = None
+        if response.status_code == 206:
+            mode = "ab"
+            content_range = response.headers.get("Content-Range", "")
+            if "/" in content_range and not content_range.endswith("/*"):
+                expected_size = int(content_range.split("/")[-1])
+        else:
+            # The server doesn't support ranges, or the file changed, so start over.
+            mode = "wb"
+            if (
+                "Content-Length" in response.headers
+                and "Content-Encoding" not in response.headers
+            ):
+                expected_size = int(response.headers["Content-Length"])
+
+            validator = _get_range_validator(response)
+            if validator is not None:
+                with open(validator_path, "w") as f:
+                    f.write(validator)
+            elif os.path.exists(validator_path):
+                os.remove(validator_path)
+
+        with response, open(partial_path, mode) as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+
+        size = os.path.getsize(partial_path)
+        if expected_size is not None and size != expected_size:
+            raise Exception(
+                f"Downloaded {size} bytes from {url}, expected {expected_size}"
+            )
+
+        os.replace(partial_path, path)
+        if os.path.exists(validator_path):
+            os.remove(validator_path)
+        return path
+
+    def download_many(
+        self, downloads: List[Tuple[str, str]], max_workers=4
+    ) -> List[str]:
+        """Concurrently downloads a list of tuples (url, path). Returns the paths."""
+
+        with ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(lambda item: self.download(*item), downloads))
+
+    def get_course_assignment_ids(self, course_id: int) -> List[int]:
+        page = self.get_page(course_id)
+
+        assignment_ids = []
+        for a in page.find_all("a"):
+            if "href" in a.attrs and "/mod/assign/view.php?id=" in a["href"]:
+                assignment_id = int(a["href"].split("id=")[-1].split("&")[0])
+                if assignment_id not in assignment_ids:
+                    assignment_ids.append(assignment_id)
+
+        return assignment_ids
+
+    def download_course_attachments(
+        self, course_id: int, directory: str, max_workers=4
+    ) -> List[str]:
+        """
+        Downloads the attachments of every assignment in the course to `directory/<assignment_id>/`.
+        Returns the paths of the downloaded files.
+        """
+
+        assignment_ids = self.get_course_assignment_ids(course_id)
+        with ThreadPoolExecutor(max_workers) as executor:
+            additional_infos = list(
+                executor.map(self.get_additional_info, assignment_ids)
+            )
+
+        downloads = [
+            (
+                attachment.url,
+                os.path.join(
+                    directory,
+                    str(assignment_id),
+                    os.path.basename(attachment.filename.strip()),
+                ),
+            )
+            for assignment_id, additional_info in zip(assignment_ids, additional_infos)
+            for attachment in additional_info.attachments
+        ]
+        return self.download_many(downloads, max_workers)
+
     def get_recordings(self, course_id: int):
-        response = self.session.post(
+        response = self._send(
+            "post",
             "https://moodle.tau.ac.il/blocks/panopto/panopto_content.php",
-            {"sesskey": self.sesskey, "courseid": course_id},
+            data={"sesskey": self.sesskey, "courseid": course_id},
         )
         response = BeautifulSoup(response.text, "html.parser")
 
@@ -293,8 +763,9 @@ class Moodle:
         ]
 
     def get_grades(self, course_id: int) -> List[GradeInfo]:
-        response = self.session.get(
-            f"https://moodle.tau.ac.il/course/user.php?mode=grade&id={course_id}&user={self.user_id}"
+        response = self._send(
+            "get",
+            f"https://moodle.tau.ac.il/course/user.php?mode=grade&id={course_id}&user={self.user_id}",
         )
         response = BeautifulSoup(response.text, "html.parser")
 
@@ -327,3 +798,179 @@ class Moodle:
             )
 
         return grades
+
+
+class AsyncMoodle:
+    """
+    An asyncio interface to Moodle, sharing the login and session of a regular `Moodle` client.
+    Requests are run in a thread pool of up to `max_concurrency` workers, which is shut down by
+    `close`, or when leaving an `async with` block.
+    """
+
+    def __init__(self, moodle: Moodle, max_concurrency=8):
+        self.moodle = moodle
+        if max_concurrency > moodle.max_connections:
+            moodle.max_connections = max_concurrency
+            moodle.session.mount("https://", HTTPAdapter(pool_maxsize=max_concurrency))
+        self.executor = ThreadPoolExecutor(max_concurrency)
+
+    @classmethod
+    async def create(
+        cls,
+        username: str,
+        id: str,
+        password: str,
+        session_file: Optional[str] = None,
+        max_concurrency=8,
+    ) -> "AsyncMoodle":
+        """Sign in without blocking the event loop."""
+
+        moodle = await asyncio.get_running_loop().run_in_executor(
+            None,
+            partial(
+                Moodle,
+                username,
+                id,
+                password,
+                session_file,
+                max_connections=max_concurrency,
+            ),
+        )
+        return cls(moodle, max_concurrency)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        # Don't block the event loop while waiting for running requests.
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def _run(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(function, *args, **kwargs)
+        )
+
+    async def get_page(
+        self, page_id: Optional[str] = None, page_url: Optional[str] = None
+    ) -> BeautifulSoup:
+        return await self._run(self.moodle.get_page, page_id, page_url)
+
+    async def get_courses(self, only_visible=True) -> List[CourseInfo]:
+        return await self._run(self.moodle.get_courses, only_visible)
+
+    async def get_assignments(
+        self, limit=50, since=0, until=100000000000
+    ) -> List[AssignmentInfo]:
+        return await self._run(self.moodle.get_assignments, limit, since, until)
+
+    async def get_additional_info(self, assignment_id: int) -> AdditionalAssignmentInfo:
+        return await self._run(self.moodle.get_additional_info, assignment_id)
+
+    async def download_url(self, url: str) -> bytes:
+        return await self._run(self.moodle.download_url, url)
+
+    async def get_recordings(self, course_id: int) -> List[RecordingInfo]:
+        return await self._run(self.moodle.get_recordings, course_id)
+
+    async def get_grades(self, course_id: int) -> List[GradeInfo]:
+        return await self._run(self.moodle.get_grades, course_id)
+
+    async def get_all_recordings(
+        self, only_visible=True
+    ) -> Dict[int, List[RecordingInfo]]:
+        """Returns the recordings of every enrolled course, keyed by the course ID."""
+
+        courses = await self.get_courses(only_visible)
+        recordings = await asyncio.gather(
+            *[self.get_recordings(course.id) for course in courses]
+        )
+        return {course.id: result for course, result in zip(courses, recordings)}
+
+    async def get_all_grades(self, only_visible=True) -> Dict[int, List[GradeInfo]]:
+        """Returns the grades of every enrolled course, keyed by the course ID."""
+
+        courses = await self.get_courses(only_visible)
+        grades = await asyncio.gather(
+            *[self.get_grades(course.id) for course in courses]
+        )
+        return {course.id: result for course, result in zip(courses, grades)}
+
+
+class MoodleBatch:
+    """
+    Queues several service calls and sends them to Moodle in a single request:
+
+    ```python
+    batch = m.batch()
+    courses = batch.get_courses()
+    assignments = batch.get_assignments()
+    batch.send()
+    print(courses.result(), assignments.result())
+    ```
+    """
+
+    def __init__(self, moodle: Moodle):
+        self.moodle = moodle
+        self.calls: List[ServiceCall] = []
+
+    def add(
+        self,
+        methodname: str,
+        args: Dict[str, Any],
+        parse: Optional[Callable[[Any], Any]] = None,
+    ) -> ServiceCall:
+        call = ServiceCall(methodname, args, parse)
+        self.calls.append(call)
+        return call
+
+    def get_courses(self, only_visible=True) -> ServiceCall:
+        return self.add(
+            "block_mycourses_get_enrolled_courses_by_timeline_classification",
+            {
+                "offset": 0,
+                "limit": 0,
+                "classification": "all",
+                "sort": "fullname",
+                "customfieldname": "",
+                "customfieldvalue": "",
+                "groupmetacourses": 1,
+            },
+            partial(_parse_courses, only_visible),
+        )
+
+    def get_assignments(
+        self,
+        limit=50,
+        since=0,
+        until=100000000000,
+        after_event_id: Optional[int] = None,
+    ) -> ServiceCall:
+        # TODO: understand the limittononsuspendedevents argument
+        args = {
+            "limitnum": limit,
+            "timesortfrom": since,
+            "timesortto": until,
+            "limittononsuspendedevents": True,
+        }
+        if after_event_id is not None:
+            args["aftereventid"] = after_event_id
+
+        return self.add(
+            "block_timeline_extra_local_get_action_events_by_timesort",
+            args,
+            _parse_assignments,
+        )
+
+    def send(self) -> List[ServiceCall]:
+        if len(self.calls) != 0:
+            self.moodle.request_services(self.calls)
+        return self.calls
@@ -1,26 +1,24 @@
+import argparse
 import json
-import time
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
 
-from rich.prompt import Prompt
+from bs4 import BeautifulSoup, Tag
 
+from tau_tools.auth import get_credentials
 from tau_tools.logging import console, log, progress, setup_logging
-from tau_tools.moodle import Moodle
+from tau_tools.moodle import Moodle, ServiceCall
+from tau_tools.utilities import RateLimiter, has_markers, request
 
 EXAM_COURSE_PAGE_ID = 5800030001
 
 
-def main(output_file="moodle-exams.json"):
-    username = Prompt.ask("Enter your Moodle username", console=console)
-    id = Prompt.ask("Enter your ID", console=console)
-    password = Prompt.ask("Enter your Moodle password", console=console)
+def get_year_links(m: Moodle) -> List[Tag]:
+    exam_course_page = m.get_page(EXAM_COURSE_PAGE_ID)
 
-    with console.status("Signing in to Moodle..."):
-        m = Moodle(username, id, password)
-
-    with console.status("Fetching exams course page..."):
-        exam_course_page = m.get_page(EXAM_COURSE_PAGE_ID)
-
-    year_links = [
+    return [
         year_link
         for year_link in exam_course_page.find_all("a", {"class": "nav-link"})
         if "href" in year_link.attrs
@@ -28,68 +26,228 @@ def main(output_file="moodle-exams.json"):
         and year_link["title"].isnumeric()
         and int(year_link["title"]) >= 2000
     ]
-    results = []
+
+
+def get_year_folders(
+    m: Moodle, year_link: Tag, rate_limiter: RateLimiter
+) -> List[Tuple[str, List[str]]]:
+    """Returns a list of tuples (school_name, folder_urls) of the schools in the year."""
+
+    rate_limiter.wait()
+    exams_year_page = m.get_page(
+        page_url=year_link["href"].replace("§ionid", "&sectionid")
+    )
+
+    return [
+        (
+            school.find("h3", {"class": "sectionname"}).text.strip(),
+            [
+                folder_link["href"]
+                for folder_link in school.find_all("a")
+                if "/folder/" in folder_link["href"]
+            ],
+        )
+        for school in exams_year_page.find_all("li", {"class": "course-section"})
+        # This is just the folder itself
+        if not school.find("h3", {"class": "sectionname"}).text.strip().isnumeric()
+    ]
+
+
+def get_folder_exams(
+    m: Moodle, folder_url: str, rate_limiter: RateLimiter
+) -> List[Tuple[str, str]]:
+    """Returns a list of tuples (filename, url) of the exams in the folder."""
+
+    rate_limiter.wait()
+    folder_page = BeautifulSoup(
+        request(
+            "get",
+            folder_url,
+            m.session,
+            delay=0,
+            retry_policy=m.retry_policy,
+            validate=has_markers(r'class="[^"]*\bfilemanager\b'),
+        ),
+        "html.parser",
+    )
+    folder = folder_page.find("div", {"class": "filemanager"})
+
+    return [(exam_link.text, exam_link["href"]) for exam_link in folder.find_all("a")]
+
+
+def get_folder_versions(m: Moodle) -> Optional[Dict[str, str]]:
+    """
+    Returns the version (revision and modification time) of every folder in the exam bank,
+    by its course module ID, or `None` if Moodle doesn't allow listing them.
+    """
+
+    call = ServiceCall(
+        "mod_folder_get_folders_by_courses", {"courseids": [EXAM_COURSE_PAGE_ID]}
+    )
+    m.request_services([call])
+    if call.error is not None:
+        log.warning(f"Couldn't list the versions of the folders: {call.error}")
+        return None
+
+    return {
+        str(folder["coursemodule"]): f"{folder['revision']}-{folder['timemodified']}"
+        for folder in call.data["folders"]
+    }
+
+
+def crawl(
+    m: Moodle,
+    max_workers=4,
+    rate=2,
+    previous_folders: Optional[Dict[str, Dict]] = None,
+) -> Tuple[List[Dict], Dict[str, Dict]]:
+    """
+    Crawls the exam bank with up to `max_workers` concurrent requests, at most `rate` per second.
+    If `previous_folders` (the folders state of a previous crawl) is given, folders whose version
+    (see `get_folder_versions`) didn't change since the previous crawl aren't requested again.
+    Returns the results and the new folders state.
+    """
+
+    rate_limiter = RateLimiter(rate)
+    incremental = previous_folders is not None
+    if previous_folders is None:
+        previous_folders = {}
+
+    year_links = get_year_links(m)
     log.info(f"Found year links {year_links}")
-    with progress:
+
+    folder_versions = (get_folder_versions(m) if incremental else None) or {}
+    folders: Dict[str, Dict] = {}
+
+    def is_unchanged(folder_url: str, version: Optional[str]) -> bool:
+        return (
+            version is not None
+            and folder_url in previous_folders
+            and previous_folders[folder_url].get("version") == version
+        )
+
+    def list_folder(folder_url: str) -> List[Tuple[str, str]]:
+        folder_id = parse_qs(urlparse(folder_url).query)["id"][0]
+        version = folder_versions.get(folder_id)
+        if is_unchanged(folder_url, version):
+            folder_exams = previous_folders[folder_url]["results"]
+        else:
+            folder_exams = get_folder_exams(m, folder_url, rate_limiter)
+
+        folders[folder_url] = {"version": version, "results": folder_exams}
+        progress.update(folders_task_id, advance=1)
+        return folder_exams
+
+    with progress, ThreadPoolExecutor(max_workers) as executor:
         years_task_id = progress.add_task(
             "[purple]Fetching years...", total=len(year_links)
         )
-        for year_link in year_links:
-            year = int(year_link["title"]) + 1
-            year_results = []
+        folders_task_id = progress.add_task("[green]Fetching folders...", total=0)
+
+        year_futures = [
+            executor.submit(get_year_folders, m, year_link, rate_limiter)
+            for year_link in year_links
+        ]
+        folder_futures: List[List[Future]] = []
+        folders_count = 0
+        for year_future in year_futures:
+            year_folders = []
+            for school_name, folder_urls in year_future.result():
+                log.info(f"Fetching {len(folder_urls)} folders in {school_name}")
+                folders_count += len(folder_urls)
+                progress.update(folders_task_id, total=folders_count)
+                year_folders += [
+                    executor.submit(list_folder, folder_url)
+                    for folder_url in folder_urls
+                ]
+            folder_futures.append(year_folders)
+            progress.update(years_task_id, advance=1)
 
-            exams_year_page = m.get_page(
-                page_url=year_link["href"].replace("§ionid", "&sectionid")
+        results = []
+        for year_link, year_folders in zip(year_links, folder_futures):
+            year_results = []
+            for folder_future in year_folders:
+                year_results += folder_future.result()
+            results.append(
+                {"results": year_results, "year": int(year_link["title"]) + 1}
             )
 
-            schools = [
-                school
-                for school in exams_year_page.find_all(
-                    "li", {"class": "course-section"}
-                )
-                # This is just the folder itself
-                if not school.find("h3", {"class": "sectionname"})
-                .text.strip()
-                .isnumeric()
-            ]
-            schools_task_id = progress.add_task(
-                "[blue]Fetching schools...", total=len(schools)
-            )
-            for school in schools:
-                school_name = school.find("h3", {"class": "sectionname"}).text.strip()
-                log.info(f"Fetching folders in {school_name}")
-
-                folders = [
-                    folder_link
-                    for folder_link in school.find_all("a")
-                    if "/folder/" in folder_link["href"]
-                ]
-                folders_task_id = progress.add_task(
-                    "[green]Fetching folders...", total=len(folders)
-                )
-                for folder_index, folder_link in enumerate(folders):
-                    print("\t\tFetching folder", f"[{folder_index+1}/{len(folders)}]")
-                    folder = m.get_page(page_url=folder_link["href"]).find(
-                        "div", {"class": "filemanager"}
-                    )
-                    for exam_link in folder.find_all("a"):
-                        year_results.append((exam_link.text, exam_link["href"]))
-
-                    time.sleep(1)
-                    progress.update(folders_task_id, advance=1)
-                progress.update(folders_task_id, visible=False)
-
-                time.sleep(1)
-                progress.update(schools_task_id, advance=1)
-            progress.update(schools_task_id, visible=False)
-
-            results.append({"results": year_results, "year": year})
-            progress.update(years_task_id, advance=1)
+    if incremental:
+        changed_folders = [
+            folder_url
+            for folder_url, folder in folders.items()
+            if not is_unchanged(folder_url, folder["version"])
+        ]
+        log.info(f"{len(changed_folders)} of {len(folders)} folders changed or are new")
+
+    return results, folders
+
+
+def main(
+    output_file="moodle-exams.json",
+    state_file="moodle-exams-state.json",
+    incremental=False,
+    max_workers=4,
+    rate=2,
+    username: Optional[str] = None,
+    id: Optional[str] = None,
+    password: Optional[str] = None,
+    session_file: Optional[str] = None,
+):
+    username, id, password = get_credentials(username, id, password)
+
+    with console.status("Signing in to Moodle..."):
+        m = Moodle(username, id, password, session_file, max_connections=max_workers)
+        if session_file is not None:
+            m.ensure_signed_in()
+
+    previous_folders = None
+    if incremental:
+        previous_folders = {}
+        if os.path.exists(state_file):
+            with open(state_file, "r") as f:
+                previous_folders = json.load(f)
+
+    results, folders = crawl(m, max_workers, rate, previous_folders)
 
     with open(output_file, "w") as f:
         json.dump(results, f, ensure_ascii=False)
 
+    with open(state_file, "w") as f:
+        json.dump(folders, f, ensure_ascii=False)
+
 
 if __name__ == "__main__":
     setup_logging()
-    main()
+
+    parser = argparse.ArgumentParser(description="Get the Moodle exam bank")
+    parser.add_argument("--output-file", default="moodle-exams.json")
+    parser.add_argument("--state-file", default="moodle-exams-state.json")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only re-list folders which changed since the last run",
+    )
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument(
+        "--rate", type=float, default=2, help="maximal requests per second"
+    )
+    parser.add_argument("--username")
+    parser.add_argument("--id")
+    parser.add_argument("--password")
+    parser.add_argument(
+        "--session-file", help="a file to persist the Moodle session in between runs"
+    )
+    args = parser.parse_args()
+
+    main(
+        args.output_file,
+        args.state_file,
+        args.incremental,
+        args.max_workers,
+        args.rate,
+        args.username,
+        args.id,
+        args.password,
+        args.session_file,
+    )
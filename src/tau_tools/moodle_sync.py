@@ -0,0 +1,400 @@
+"""
+Mirror the contents of Moodle courses (resources, folders and assignment attachments) to a local directory.
+A manifest of the mirrored URLs, sizes, timestamps and hashes is kept next to the files, so repeated
+syncs only fetch and write new or changed files, and remove files which were moved or deleted on Moodle.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+from urllib.parse import unquote, urlparse
+
+import requests
+from bs4 import Tag
+
+from tau_tools.auth import get_credentials
+from tau_tools.logging import log, progress, setup_logging
+from tau_tools.moodle import Moodle
+from tau_tools.utilities import InvalidResponseException, send
+
+MANIFEST_FILE = ".manifest.json"
+MANIFEST_SAVE_INTERVAL = 5
+"""The minimal number of seconds between saves of the manifest during a sync"""
+
+
+@dataclass
+class MirroredFile:
+    url: str
+    path: str
+    """The path of the file, relative to the mirror directory"""
+    size: int
+    last_modified: Optional[str]
+    """The `Last-Modified` header returned by Moodle"""
+    etag: Optional[str]
+    sha256: str
+    synced_at: float
+    """The UNIX timestamp of the last time the file was fetched"""
+
+
+@dataclass
+class SyncResult:
+    new: List[str]
+    changed: List[str]
+    unchanged: List[str]
+    removed: List[str]
+    failed: List[str]
+    """The URLs which couldn't be resolved or fetched, whose previous files are kept"""
+
+
+def _safe_name(name: str) -> str:
+    return name.strip().replace("/", "_").replace("\\", "_") or "_"
+
+
+def _deduplicate_paths(files: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """
+    Drops repeated URLs, and adds a suffix to paths which are already taken (e.g. two resources
+    with the same name in a section), so that no two files are written to the same path.
+    """
+
+    result = []
+    urls = set()
+    paths = set()
+    for url, path in files:
+        if url in urls:
+            continue
+
+        base, extension = os.path.splitext(path)
+        unique_path = path
+        suffix = 2
+        while unique_path in paths:
+            unique_path = f"{base} ({suffix}){extension}"
+            suffix += 1
+
+        urls.add(url)
+        paths.add(unique_path)
+        result.append((url, unique_path))
+    return result
+
+
+def _get_link_name(a: Tag) -> str:
+    instance_name = a.find("span", {"class": "instancename"})
+    if instance_name is None:
+        return a.text.strip()
+
+    # Moodle appends the module type in a hidden span, e.g. "Lecture 1 File".
+    for hidden in instance_name.find_all("span", {"class": "accesshide"}):
+        hidden.extract()
+    return instance_name.text.strip()
+
+
+T = TypeVar("T")
+
+
+def get_course_files(
+    m: Moodle, course_id: int, max_workers=4
+) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """
+    Returns a list of tuples (url, path) of all of the files in the course,
+    where the paths are relative and grouped by the course sections,
+    and a list of the URLs of the resources, folders and assignments which couldn't be resolved.
+    """
+
+    page = m.get_page(course_id)
+    sections = page.find_all("li", {"class": "course-section"}) or [page]
+
+    resources: List[Tuple[str, str, str]] = []
+    folders: List[Tuple[str, str, str]] = []
+    assignments: List[Tuple[str, str, int]] = []
+    seen = set()
+    for section in sections:
+        section_name_element = section.find("h3", {"class": "sectionname"})
+        section_name = (
+            _safe_name(section_name_element.text)
+            if section_name_element is not None
+            else ""
+        )
+
+        for a in section.find_all("a"):
+            if "href" not in a.attrs or a["href"] in seen:
+                continue
+            seen.add(a["href"])
+
+            name = _safe_name(_get_link_name(a))
+            if "/mod/resource/view.php" in a["href"]:
+                resources.append((section_name, name, a["href"]))
+            elif "/mod/folder/view.php" in a["href"]:
+                folders.append((section_name, name, a["href"]))
+            elif "/mod/assign/view.php?id=" in a["href"]:
+                assignment_id = int(a["href"].split("id=")[-1].split("&")[0])
+                assignments.append((section_name, name, assignment_id))
+
+    def resolve_resource(resource: Tuple[str, str, str]) -> List[Tuple[str, str]]:
+        section_name, name, url = resource
+        # Resources redirect to the file itself.
+        response = send(
+            "head",
+            url + "&redirect=1",
+            m.session,
+            m.retry_policy,
+            allow_redirects=True,
+        )
+        filename = unquote(os.path.basename(urlparse(response.url).path))
+        extension = os.path.splitext(filename)[1]
+        return [(response.url, os.path.join(section_name, name + extension))]
+
+    def resolve_folder(folder: Tuple[str, str, str]) -> List[Tuple[str, str]]:
+        section_name, name, url = folder
+        filemanager = m.get_page(page_url=url).find("div", {"class": "filemanager"})
+        if filemanager is None:
+            return []
+
+        return [
+            (a["href"], os.path.join(section_name, name, _safe_name(a.text)))
+            for a in filemanager.find_all("a")
+            if "href" in a.attrs and "pluginfile.php" in a["href"]
+        ]
+
+    def resolve_assignment(assignment: Tuple[str, str, int]) -> List[Tuple[str, str]]:
+        section_name, name, assignment_id = assignment
+        return [
+            (
+                attachment.url,
+                os.path.join(section_name, name, _safe_name(attachment.filename)),
+            )
+            for attachment in m.get_additional_info(assignment_id).attachments
+        ]
+
+    failed: List[str] = []
+
+    def resolve(
+        resolver: Callable[[T], List[Tuple[str, str]]], item: T, url: str
+    ) -> List[Tuple[str, str]]:
+        try:
+            return resolver(item)
+        except (requests.RequestException, InvalidResponseException) as e:
+            log.warning(f"Failed resolving {url}: {e}")
+            failed.append(url)
+            return []
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = (
+            [
+                executor.submit(resolve, resolve_resource, resource, resource[2])
+                for resource in resources
+            ]
+            + [
+                executor.submit(resolve, resolve_folder, folder, folder[2])
+                for folder in folders
+            ]
+            + [
+                executor.submit(
+                    resolve, resolve_assignment, assignment, str(assignment[2])
+                )
+                for assignment in assignments
+            ]
+        )
+        files = _deduplicate_paths(
+            [file for future in futures for file in future.result()]
+        )
+    return files, failed
+
+
+def load_manifest(directory: str) -> Dict[str, MirroredFile]:
+    manifest_file = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+
+    with open(manifest_file, "r") as f:
+        return {url: MirroredFile(**info) for url, info in json.load(f).items()}
+
+
+def save_manifest(directory: str, manifest: Dict[str, MirroredFile]):
+    manifest_file = os.path.join(directory, MANIFEST_FILE)
+    with open(manifest_file + ".part", "w") as f:
+        json.dump(
+            {url: asdict(info) for url, info in manifest.items()},
+            f,
+            ensure_ascii=False,
+        )
+    os.replace(manifest_file + ".part", manifest_file)
+
+
+def _remove_file(directory: str, path: str):
+    """Removes the file at `directory/path`, along with the directories it leaves empty."""
+
+    full_path = os.path.join(directory, path)
+    if os.path.exists(full_path):
+        os.remove(full_path)
+
+    parent = os.path.dirname(path)
+    while parent != "":
+        parent_path = os.path.join(directory, parent)
+        if not os.path.isdir(parent_path) or len(os.listdir(parent_path)) != 0:
+            break
+        os.rmdir(parent_path)
+        parent = os.path.dirname(parent)
+
+
+def sync_file(
+    m: Moodle,
+    url: str,
+    path: str,
+    directory: str,
+    previous: Optional[MirroredFile],
+    chunk_size=1 << 20,
+) -> Tuple[MirroredFile, bool]:
+    """
+    Fetches `url` into `directory/path` unless it didn't change since `previous`.
+    Returns the new manifest entry and whether the file content changed.
+    """
+
+    full_path = os.path.join(directory, path)
+    is_present = previous is not None and os.path.exists(
+        os.path.join(directory, previous.path)
+    )
+
+    headers = {}
+    if is_present and previous.etag is not None:
+        headers["If-None-Match"] = previous.etag
+    if is_present and previous.last_modified is not None:
+        headers["If-Modified-Since"] = previous.last_modified
+
+    response = send("get", url, m.session, m.retry_policy, stream=True, headers=headers)
+    if response.status_code == 304:
+        response.close()
+        if previous.path != path:
+            os.makedirs(os.path.dirname(os.path.abspath(full_path)), exist_ok=True)
+            os.replace(os.path.join(directory, previous.path), full_path)
+        return MirroredFile(**{**asdict(previous), "path": path}), False
+
+    os.makedirs(os.path.dirname(os.path.abspath(full_path)), exist_ok=True)
+    partial_path = full_path + ".part"
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with response, open(partial_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size):
+                sha256.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(partial_path)
+        raise
+
+    mirrored_file = MirroredFile(
+        url,
+        path,
+        size,
+        response.headers.get("Last-Modified"),
+        response.headers.get("ETag"),
+        sha256.hexdigest(),
+        time.time(),
+    )
+
+    if is_present and previous.sha256 == mirrored_file.sha256 and previous.path == path:
+        # Moodle doesn't always support conditional requests, so avoid rewriting identical files.
+        os.remove(partial_path)
+        return mirrored_file, False
+
+    os.replace(partial_path, full_path)
+    return mirrored_file, True
+
+
+def sync_course(m: Moodle, course_id: int, directory: str, max_workers=4) -> SyncResult:
+    """
+    Mirrors the files of the course to `directory`, only fetching new or changed files,
+    and removing files which are no longer in the course.
+    The manifest is saved as files are synced, so an interrupted sync keeps its progress.
+    Files which fail to sync are logged and keep their previous copy.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    manifest = load_manifest(directory)
+    previous_paths = {mirrored_file.path for mirrored_file in manifest.values()}
+    result = SyncResult([], [], [], [], [])
+
+    files, result.failed = get_course_files(m, course_id, max_workers)
+    log.info(f"Found {len(files)} files in course {course_id}")
+
+    try:
+        with progress, ThreadPoolExecutor(max_workers) as executor:
+            files_task_id = progress.add_task(
+                "[green]Syncing files...", total=len(files)
+            )
+
+            def sync(file: Tuple[str, str]) -> Tuple[str, Optional[MirroredFile], bool]:
+                url, path = file
+                try:
+                    mirrored_file, is_changed = sync_file(
+                        m, url, path, directory, manifest.get(url)
+                    )
+                except (requests.RequestException, InvalidResponseException) as e:
+                    log.warning(f"Failed syncing {url}: {e}")
+                    mirrored_file, is_changed = None, False
+                progress.update(files_task_id, advance=1)
+                return url, mirrored_file, is_changed
+
+            last_save = time.monotonic()
+            for url, mirrored_file, is_changed in executor.map(sync, files):
+                if mirrored_file is None:
+                    result.failed.append(url)
+                    continue
+
+                if url not in manifest:
+                    result.new.append(mirrored_file.path)
+                elif is_changed:
+                    result.changed.append(mirrored_file.path)
+                else:
+                    result.unchanged.append(mirrored_file.path)
+                manifest[url] = mirrored_file
+
+                if time.monotonic() - last_save >= MANIFEST_SAVE_INTERVAL:
+                    save_manifest(directory, manifest)
+                    last_save = time.monotonic()
+
+            progress.update(files_task_id, visible=False)
+
+        # Remove the files which were deleted from the course, and the old paths of moved files.
+        # A failed file keeps its manifest entry, so its path is still in use.
+        urls = {url for url, _ in files}
+        paths = {path for _, path in files} | {
+            manifest[url].path for url in result.failed if url in manifest
+        }
+        if any(url not in urls for url in result.failed):
+            # The files of an unresolved resource are unknown, so nothing can be safely removed.
+            log.warning(
+                "Some of the course couldn't be resolved, not removing any file"
+            )
+        else:
+            for previous_path in sorted(previous_paths - paths):
+                if os.path.exists(os.path.join(directory, previous_path)):
+                    result.removed.append(previous_path)
+                _remove_file(directory, previous_path)
+            for url in list(manifest):
+                if url not in urls:
+                    del manifest[url]
+    finally:
+        save_manifest(directory, manifest)
+
+    log.info(
+        f"Synced course {course_id}: {len(result.new)} new, {len(result.changed)} changed, {len(result.unchanged)} unchanged, {len(result.removed)} removed, {len(result.failed)} failed"
+    )
+    return result
+
+
+if __name__ == "__main__":
+    setup_logging()
+
+    if len(sys.argv) != 3:
+        print("Usage: python3 -m tau_tools.moodle_sync <course_id> <directory>")
+        sys.exit(1)
+
+    username, id, password = get_credentials()
+    m = Moodle(username, id, password, os.environ.get("TAU_TOOLS_SESSION_FILE"))
+    m.ensure_signed_in()
+    sync_course(m, int(sys.argv[1]), sys.argv[2])
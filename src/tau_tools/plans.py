@@ -3,37 +3,33 @@ Download all of the study plans at Tel Aviv University.
 This file has been created by inspecting the network requests when accessing https://exact-sciences.tau.ac.il/search-studies-programs?faculta=0300.
 """
 
+import hashlib
 import json
 import math
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterator, List, Optional, Any, Tuple
 
-from tau_tools.logging import progress, setup_logging, log
-from tau_tools.utilities import request
+from tau_tools.graphql import GraphQLClient, GraphQLOperation
+from tau_tools.instrumentation import instrumentation
+from tau_tools.logging import console, setup_logging, log
 
+API_URL = "https://tochniot.tau.ac.il/graphql"
+RESULTS_QUERY = "query results($apiUrl: String!, $filters: JSON!) {\n  results(apiUrl: $apiUrl, filters: $filters) {\n    body\n    __typename\n  }\n}\n"
 
-def request_graphql(
-    request_json,
-    api_url="https://tochniot.tau.ac.il/graphql",
-    delay=1,
-    cache_key: Optional[str] = None,
-):
-    """
-    Send a GraphQL request to the `api_url`.
-    Check for errors.
-    Sleep for `delay` seconds, to prevent overwhelming anything.
-    """
+PROGRAMS_PAGE_SIZE = 100
 
-    response = request(
-        "post",
-        api_url,
-        json=request_json,
-        cache_category="plans",
-        cache_key=cache_key,
-        delay=delay,
-    )
-    result = json.loads(response)["data"]
+client = GraphQLClient(API_URL, cache_category="plans")
+"""The client used for all of the requests. Its results are cached by their query and variables."""
+
+
+def _check_result(result: Any):
+    """Raise the error returned by the TAU API, if any."""
+
+    if isinstance(result, Exception):
+        raise result
 
     if (
         "results" in result
@@ -43,9 +39,33 @@ def request_graphql(
     ):
         raise Exception(result["results"]["body"]["Tau"]["errmsgeng"])
 
+
+def request_graphql(operation: GraphQLOperation):
+    """
+    Execute a GraphQL operation using the `client`.
+    Check for errors.
+    """
+
+    result = client.execute(operation)
+    _check_result(result)
     return result
 
 
+def request_graphql_many(operations: List[GraphQLOperation]) -> List[Any]:
+    """
+    Execute all of the `operations`, batching them when possible.
+    Failed operations return their exception instead of raising it.
+    """
+
+    results = client.execute_many(operations, return_exceptions=True)
+    for i, result in enumerate(results):
+        try:
+            _check_result(result)
+        except Exception as e:
+            results[i] = e
+    return results
+
+
 @dataclass
 class DepartmentInfo:
     name: str
@@ -70,47 +90,66 @@ class PlanInfo:
     def __init__(
         self, name: str, id: Optional[str], language: str, year: str, egedid: str
     ):
+        """If the `id` is missing, it can be found later using `find_id`."""
+
         self.name = name
         self.id = id
         self.language = language
+        self.year = year
+        self.egedid = egedid
+
+    def get_find_id_operation(self) -> GraphQLOperation:
+        return GraphQLOperation(
+            "results",
+            RESULTS_QUERY,
+            {
+                "filters": {
+                    "safa": "1",
+                    "shana": self.year,
+                    "egedid": self.egedid,
+                    "tab": "generalExplanation",
+                },
+                "apiUrl": "ydhesberklali",
+            },
+        )
 
-        if id is None:
-            self.find_id(year, egedid)
-
-    def find_id(self, year: str, egedid: str):
-        """Tries to find the plan id (tcid) from the `year` and `egedid`"""
+    def set_id_from_result(self, result: Any):
         try:
-            response = request_graphql(
-                {
-                    "operationName": "results",
-                    "variables": {
-                        "filters": {
-                            "safa": "1",
-                            "shana": year,
-                            "egedid": egedid,
-                            "tab": "generalExplanation",
-                        },
-                        "apiUrl": "ydhesberklali",
-                    },
-                    "query": "query results($apiUrl: String!, $filters: JSON!) {\n  results(apiUrl: $apiUrl, filters: $filters) {\n    body\n    __typename\n  }\n}\n",
-                },
-                cache_key=f"get-id-{year}-{egedid}",
-            )
-            self.id = response["results"]["body"][0]["tcid"]
+            _check_result(result)
+            self.id = result["results"]["body"][0]["tcid"]
         except Exception:
             pass
 
+    def find_id(self):
+        """Tries to find the plan id (tcid) from the year and `egedid`"""
+
+        try:
+            result = client.execute(self.get_find_id_operation())
+        except Exception:
+            return
+        self.set_id_from_result(result)
+
+
+def resolve_plan_ids(plans: List[PlanInfo]):
+    """Finds the ids of all of the `plans` which are missing them, in batches."""
+
+    missing_id_plans = [plan for plan in plans if plan.id is None]
+    results = request_graphql_many(
+        [plan.get_find_id_operation() for plan in missing_id_plans]
+    )
+    for plan, result in zip(missing_id_plans, results):
+        plan.set_id_from_result(result)
+
 
 def get_schools() -> List[SchoolInfo]:
     """Returns a list of tuples (name, id) of the schools."""
 
     hierarchy = request_graphql(
-        {
-            "operationName": "getProgramsHierarchy",
-            "variables": {"search": {"safa": "1"}},
-            "query": "query getProgramsHierarchy($search: JSON!) {\n  getProgramsHierarchy(search: $search) {\n    id\n    name\n    rama {\n      hasUndefinedBetsefer\n      id\n      name\n      field\n      rama {\n        id\n        name\n        field\n        chug\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
-        },
-        cache_key="schools",
+        GraphQLOperation(
+            "getProgramsHierarchy",
+            "query getProgramsHierarchy($search: JSON!) {\n  getProgramsHierarchy(search: $search) {\n    id\n    name\n    rama {\n      hasUndefinedBetsefer\n      id\n      name\n      field\n      rama {\n        id\n        name\n        field\n        chug\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",
+            {"search": {"safa": "1"}},
+        )
     )
 
     return [
@@ -134,52 +173,51 @@ def get_schools() -> List[SchoolInfo]:
     ]
 
 
-def get_plans(school: SchoolInfo) -> List[PlanInfo]:
-    """Get all of the available plans at the specified school."""
-
-    plans = request_graphql(
+def _get_plans_operation(
+    school: SchoolInfo, start=0, size=PROGRAMS_PAGE_SIZE
+) -> GraphQLOperation:
+    return GraphQLOperation(
+        "getPrograms",
+        "query getPrograms($search: JSON!, $from: Int, $size: Int) {\n  getPrograms(search: $search, from: $from, size: $size) {\n    total\n    results {\n      tclongkey\n      shana\n      teur\n      toar\n      currentSafa\n      isSafaAfucha\n      tcid\n      egedid\n      faculta\n      teurfaculta\n      teurfacultaeng\n      betsefer\n      teurbetsefer\n      teurbetsefereng\n      maslul\n      chug\n      teurchug\n      teurchugeng\n      teurfaculta2\n      teurfacultaeng2\n      pail\n      title\n      pailheara\n      pailhearaeng\n      showtochnit\n      __typename\n    }\n    from\n    refreshData\n    __typename\n  }\n}\n",
         {
-            "operationName": "getPrograms",
-            "variables": {
-                "search": {
-                    "safa": "1",
-                    "faculta": [
-                        {
-                            "id": school.id,
-                            "name": school.name,
-                            "__typename": "HierarchyFilter",
-                            "rama": [
-                                {
-                                    "id": faculty.id,
-                                    "name": faculty.name,
-                                    "__typename": "BetseferFilter",
-                                    "hasUndefinedBetsefer": "false",
-                                    "field": "betsefer",
-                                    "rama": [
-                                        {
-                                            "id": department.id,
-                                            "name": department.name,
-                                            "__typename": "ChugFilter",
-                                            "field": "chug",
-                                            "chug": True,
-                                        }
-                                        for department in faculty.departments
-                                    ],
-                                }
-                                for faculty in school.faculties
-                            ],
-                        }
-                    ],
-                    "isLoadPrograms": True,
-                },
-                "from": 0,
-                "size": 1000,
+            "search": {
+                "safa": "1",
+                "faculta": [
+                    {
+                        "id": school.id,
+                        "name": school.name,
+                        "__typename": "HierarchyFilter",
+                        "rama": [
+                            {
+                                "id": faculty.id,
+                                "name": faculty.name,
+                                "__typename": "BetseferFilter",
+                                "hasUndefinedBetsefer": "false",
+                                "field": "betsefer",
+                                "rama": [
+                                    {
+                                        "id": department.id,
+                                        "name": department.name,
+                                        "__typename": "ChugFilter",
+                                        "field": "chug",
+                                        "chug": True,
+                                    }
+                                    for department in faculty.departments
+                                ],
+                            }
+                            for faculty in school.faculties
+                        ],
+                    }
+                ],
+                "isLoadPrograms": True,
             },
-            "query": "query getPrograms($search: JSON!, $from: Int, $size: Int) {\n  getPrograms(search: $search, from: $from, size: $size) {\n    total\n    results {\n      tclongkey\n      shana\n      teur\n      toar\n      currentSafa\n      isSafaAfucha\n      tcid\n      egedid\n      faculta\n      teurfaculta\n      teurfacultaeng\n      betsefer\n      teurbetsefer\n      teurbetsefereng\n      maslul\n      chug\n      teurchug\n      teurchugeng\n      teurfaculta2\n      teurfacultaeng2\n      pail\n      title\n      pailheara\n      pailhearaeng\n      showtochnit\n      __typename\n    }\n    from\n    refreshData\n    __typename\n  }\n}\n",
+            "from": start,
+            "size": size,
         },
-        cache_key=f"plans-{school.id}",
     )
 
+
+def _parse_plans(plans: Any) -> List[PlanInfo]:
     return [
         PlanInfo(
             result["teur"],
@@ -192,24 +230,100 @@ def get_plans(school: SchoolInfo) -> List[PlanInfo]:
     ]
 
 
-def get_plan(plan: PlanInfo, year=2024) -> Dict[str, Any]:
-    details = request_graphql(
+def _get_remaining_pages(
+    school: SchoolInfo, first_page: Any, page_size: int
+) -> List[GraphQLOperation]:
+    total = first_page["getPrograms"].get("total") or 0
+    return [
+        _get_plans_operation(school, start, page_size)
+        for start in range(page_size, total, page_size)
+    ]
+
+
+def iter_plans(school: SchoolInfo, page_size=PROGRAMS_PAGE_SIZE) -> Iterator[PlanInfo]:
+    """
+    Yields all of the available plans at the specified school, page by page.
+    The pages after the first one are fetched in parallel.
+    Some of the plans may be missing their ids, see `resolve_plan_ids`.
+    """
+
+    first_page = request_graphql(_get_plans_operation(school, 0, page_size))
+    yield from _parse_plans(first_page)
+
+    with ThreadPoolExecutor(client.max_workers) as executor:
+        for page in executor.map(
+            request_graphql, _get_remaining_pages(school, first_page, page_size)
+        ):
+            yield from _parse_plans(page)
+
+
+def iter_all_plans(
+    schools: List[SchoolInfo], page_size=PROGRAMS_PAGE_SIZE
+) -> Iterator[Tuple[SchoolInfo, PlanInfo]]:
+    """
+    Yields the plans of all of the `schools`, fetching the first page of every school in a batch,
+    and then the rest of the pages. Schools whose plans can't be fetched are skipped.
+    """
+
+    first_pages = request_graphql_many(
+        [_get_plans_operation(school, 0, page_size) for school in schools]
+    )
+
+    remaining_pages: List[Tuple[SchoolInfo, GraphQLOperation]] = []
+    for school, page in zip(schools, first_pages):
+        if isinstance(page, Exception):
+            log.warning(
+                f"Error fetching the plans of {school.name}: [red]{page}[/red]",
+                extra={"markup": True}
+            )
+            continue
+
+        for plan in _parse_plans(page):
+            yield school, plan
+        remaining_pages += [
+            (school, operation)
+            for operation in _get_remaining_pages(school, page, page_size)
+        ]
+
+    pages = request_graphql_many([operation for _, operation in remaining_pages])
+    for (school, operation), page in zip(remaining_pages, pages):
+        if isinstance(page, Exception):
+            log.warning(
+                f"Error fetching the plans of {school.name} from {operation.variables['from']}: [red]{page}[/red]",
+                extra={"markup": True}
+            )
+            continue
+
+        for plan in _parse_plans(page):
+            yield school, plan
+
+
+def get_plans(school: SchoolInfo) -> List[PlanInfo]:
+    """
+    Get all of the available plans at the specified school.
+    Some of the plans may be missing their ids, see `resolve_plan_ids`.
+    """
+
+    return list(iter_plans(school))
+
+
+def _get_plan_operation(plan: PlanInfo, year: int) -> GraphQLOperation:
+    return GraphQLOperation(
+        "results",
+        RESULTS_QUERY,
         {
-            "operationName": "results",
-            "variables": {
-                "filters": {
-                    "tcid": plan.id,
-                    "shana": str(year),
-                    "safa": plan.language,
-                    "tab": "programStudy",
-                },
-                "apiUrl": "ydtochnit",
+            "filters": {
+                "tcid": plan.id,
+                "shana": str(year),
+                "safa": plan.language,
+                "tab": "programStudy",
             },
-            "query": "query results($apiUrl: String!, $filters: JSON!) {\n  results(apiUrl: $apiUrl, filters: $filters) {\n    body\n    __typename\n  }\n}\n",
+            "apiUrl": "ydtochnit",
         },
-        cache_key=f"plan-{year}-{plan.id}-{plan.language}",
     )
 
+
+def _parse_plan(details: Any) -> Dict[str, Any]:
     categories = {}
 
     for part in details["results"]["body"][0]["rama"]:
@@ -259,41 +373,129 @@ def get_plan(plan: PlanInfo, year=2024) -> Dict[str, Any]:
     return categories
 
 
-def main(output_file_template="plans-{year}.json", year=2024):
-    result = {}
+def get_plan(plan: PlanInfo, year=2024) -> Dict[str, Any]:
+    return _parse_plan(request_graphql(_get_plan_operation(plan, year)))
 
-    schools = get_schools()
-    with progress:
-        schools_task_id = progress.add_task(
-            "[purple]Fetching schools...", total=len(schools)
-        )
-        for school in schools:
-            result[school.name] = {}
-            plans = [plan for plan in get_plans(school) if plan.id is not None]
-            school_task_id = progress.add_task(
-                f"[green]Fetching school '{school.name}' plans...", total=len(plans)
+
+class PlanStore:
+    """
+    Parsed plan details, stored by the hash of their content.
+    Plans which didn't change between years are stored only once.
+    """
+
+    def __init__(self):
+        self.plans: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, details: Any) -> str:
+        """Parses the `details`, stores them unless they're already stored, and returns their hash."""
+
+        # The raw details contain the year and ID of the plan, so only the parsed categories
+        # (which contain neither) are the same between years.
+        with instrumentation.timer("parse"):
+            plan_details = _parse_plan(details)
+        content_hash = hashlib.sha256(
+            json.dumps(plan_details, sort_keys=True, ensure_ascii=False).encode()
+        ).hexdigest()
+
+        with self.lock:
+            self.plans.setdefault(content_hash, plan_details)
+        return content_hash
+
+
+def _get_plan_details(
+    plans: List[Tuple[SchoolInfo, PlanInfo]], years: List[int], store: PlanStore
+) -> List[Tuple[SchoolInfo, PlanInfo, int, str]]:
+    """
+    Finds the missing ids of the `plans` and fetches their details in all of the `years`.
+    Returns tuples (school, plan, year, hash) of the details added to the `store`.
+    """
+
+    resolve_plan_ids([plan for _, plan in plans])
+    plan_years = [
+        (school, plan, year)
+        for school, plan in plans
+        if plan.id is not None
+        for year in years
+    ]
+    plan_results = request_graphql_many(
+        [_get_plan_operation(plan, year) for _, plan, year in plan_years]
+    )
+
+    results = []
+    for (school, plan, year), details in zip(plan_years, plan_results):
+        try:
+            if isinstance(details, Exception):
+                raise details
+            results.append((school, plan, year, store.add(details)))
+        except Exception as e:
+            log.warning(
+                f"Error fetching {plan.name} in {school.name} ({year}): [red]{e}[/red]",
+                extra={"markup": True}
             )
-            for plan in plans:
-                try:
-                    plan_details = get_plan(plan, year)
-                    if len(plan_details) != 0:
-                        result[school.name][plan.name] = plan_details
-                except Exception as e:
-                    log.warning(
-                        f"Error fetching {plan.name} in {school.name}: [red]{e}[/red]",
-                        extra={"markup": True}
-                    )
-                progress.update(school_task_id, advance=1)
-            progress.update(school_task_id, visible=False)
-            progress.update(schools_task_id, advance=1)
-
-    with open(output_file_template.format(year=year + 1), "w") as f:
-        json.dump(result, f, ensure_ascii=False)
+    return results
+
+
+def main(
+    output_file_template="plans-{year}.json",
+    year=2024,
+    max_workers=8,
+    rate=10,
+    years: Optional[List[int]] = None,
+):
+    """
+    Fetches the plans of all of the schools in the `year`, or in all of the `years` if given,
+    with up to `max_workers` concurrent requests, at most `rate` per second.
+    The schools and plans are listed once for all of the years, operations of every stage are
+    batched when the API supports it, and the details of the plans are fetched while the next
+    pages of plans are still being listed.
+    """
+
+    if years is None:
+        years = [year]
+
+    client.max_workers = max_workers
+    client.set_rate(rate)
+    chunk_size = max(1, client.batch_size * max_workers // len(years))
+    store = PlanStore()
+
+    with console.status("Fetching schools..."):
+        schools = get_schools()
+    results = {year: {school.name: {} for school in schools} for year in years}
+
+    with console.status("Fetching plans..."), ThreadPoolExecutor(2) as executor:
+        chunk_futures: List[Future] = []
+        chunk: List[Tuple[SchoolInfo, PlanInfo]] = []
+        for school_plan in iter_all_plans(schools):
+            chunk.append(school_plan)
+            if len(chunk) == chunk_size:
+                chunk_futures.append(
+                    executor.submit(_get_plan_details, chunk, years, store)
+                )
+                chunk = []
+        chunk_futures.append(executor.submit(_get_plan_details, chunk, years, store))
+
+        plans_count = 0
+        for chunk_future in chunk_futures:
+            for school, plan, year, content_hash in chunk_future.result():
+                plans_count += 1
+                if len(store.plans[content_hash]) != 0:
+                    results[year][school.name][plan.name] = store.plans[content_hash]
+
+    log.info(f"Fetched {plans_count} plans, {len(store.plans)} of them unique")
+
+    for year in years:
+        with instrumentation.timer("json write"), open(
+            output_file_template.format(year=year + 1), "w"
+        ) as f:
+            json.dump(results[year], f, ensure_ascii=False)
+
+    instrumentation.report()
 
 
 if __name__ == "__main__":
     setup_logging()
-    if len(sys.argv) == 2:
-        main(year=int(sys.argv[1]) - 1)
+    if len(sys.argv) >= 2:
+        main(years=[int(year) - 1 for year in sys.argv[1:]])
     else:
         main()
@@ -0,0 +1,219 @@
+"""
+Run IMS and Moodle jobs for many accounts on a shared pool of workers.
+Jobs of the same account run one at a time on its own clients, while jobs of different accounts
+run concurrently, subject to per-host rate limits shared by all of the accounts of the pool, and a
+bound on concurrent sign-ins.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from tau_tools.auth import SessionStore
+from tau_tools.ims import IMS
+from tau_tools.logging import log
+from tau_tools.moodle import Moodle
+from tau_tools.utilities import DEFAULT_RETRY_POLICY, RateLimiter, RetryPolicy
+
+T = TypeVar("T")
+
+DEFAULT_HOST_RATES = {
+    "iims.tau.ac.il": 10,
+    "moodle.tau.ac.il": 20,
+    "nidp.tau.ac.il": 5,
+}
+"""The default maximal requests per second to every host, across all accounts of a pool"""
+
+
+@dataclass
+class Account:
+    username: str
+    id: str
+    password: str
+
+
+class AccountClients:
+    """The clients of a single account. They are created (and signed in) on first use."""
+
+    def __init__(self, account: Account, store: SessionStore):
+        self.account = account
+        self.store = store
+        self._ims: Optional[IMS] = None
+        self._moodle: Optional[Moodle] = None
+
+    @property
+    def ims(self) -> IMS:
+        if self._ims is None:
+            self._ims = IMS(
+                self.account.username,
+                self.account.id,
+                self.account.password,
+                self.store.retry_policy,
+                store=self.store,
+            )
+        return self._ims
+
+    @property
+    def moodle(self) -> Moodle:
+        if self._moodle is None:
+            self._moodle = Moodle(
+                self.account.username,
+                self.account.id,
+                self.account.password,
+                retry_policy=self.store.retry_policy,
+                store=self.store,
+            )
+        return self._moodle
+
+
+class PoolMetrics:
+    """Counts the jobs run by a `ClientPool`, for measuring its throughput."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.completed = 0
+        self.failed = 0
+        self.job_seconds = 0.0
+
+    def record_job(self, seconds: float, failed: bool):
+        with self.lock:
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+            self.job_seconds += seconds
+
+    def jobs_per_hour(self) -> float:
+        elapsed = time.monotonic() - self.started_at
+        return 3600 * (self.completed + self.failed) / elapsed if elapsed > 0 else 0
+
+    def __repr__(self):
+        return f"PoolMetrics(completed={self.completed}, failed={self.failed}, jobs_per_hour={self.jobs_per_hour():.0f})"
+
+
+class ClientPool:
+    def __init__(
+        self,
+        accounts: List[Account],
+        max_workers=16,
+        max_concurrent_sign_ins=4,
+        host_rates: Dict[str, float] = DEFAULT_HOST_RATES,
+        session_directory: Optional[str] = None,
+        retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    ):
+        """
+        Creates a pool running jobs of the `accounts` on up to `max_workers` threads.
+        The sessions of the accounts are persisted to `session_directory` if it's given.
+        """
+
+        self.accounts = {account.username: account for account in accounts}
+        self.session_directory = session_directory
+        self.retry_policy = retry_policy
+        self.metrics = PoolMetrics()
+        self.sign_in_semaphore = threading.Semaphore(max_concurrent_sign_ins)
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.clients: Dict[str, AccountClients] = {}
+        self.queues: Dict[str, Deque[Tuple[Callable, Future]]] = {}
+        self.running = set()
+
+        # Scoped to the sessions of the pool, so other clients in the process aren't limited.
+        self.rate_limiters = {
+            host: RateLimiter(rate) for host, rate in host_rates.items()
+        }
+
+        if session_directory is not None:
+            os.makedirs(session_directory, exist_ok=True)
+
+    def get_clients(self, username: str) -> AccountClients:
+        with self.lock:
+            if username not in self.clients:
+                account = self.accounts[username]
+                session_file = (
+                    os.path.join(self.session_directory, f"{username}.json")
+                    if self.session_directory is not None
+                    else None
+                )
+                store = SessionStore(
+                    account.username,
+                    account.id,
+                    account.password,
+                    session_file,
+                    self.retry_policy,
+                    sign_in_semaphore=self.sign_in_semaphore,
+                    rate_limiters=self.rate_limiters,
+                )
+                self.clients[username] = AccountClients(account, store)
+            return self.clients[username]
+
+    def submit(self, username: str, job: Callable[[AccountClients], T]) -> "Future[T]":
+        """Schedules `job` to run with the clients of the account, after its previous jobs."""
+
+        future: "Future[T]" = Future()
+        with self.lock:
+            self.queues.setdefault(username, deque()).append((job, future))
+            if username in self.running:
+                return future
+            self.running.add(username)
+
+        self.executor.submit(self._run_next, username)
+        return future
+
+    def _run_next(self, username: str):
+        with self.lock:
+            job, future = self.queues[username].popleft()
+
+        if future.set_running_or_notify_cancel():
+            start = time.monotonic()
+            try:
+                result = job(self.get_clients(username))
+            except Exception as e:
+                log.warning(f"A job of {username} failed: {e}")
+                self.metrics.record_job(time.monotonic() - start, failed=True)
+                future.set_exception(e)
+            else:
+                self.metrics.record_job(time.monotonic() - start, failed=False)
+                future.set_result(result)
+
+        with self.lock:
+            if len(self.queues[username]) == 0:
+                self.running.discard(username)
+                if len(self.running) == 0:
+                    self.idle.notify_all()
+                return
+
+        # Requeue instead of looping, so that accounts with many jobs don't starve the others.
+        self.executor.submit(self._run_next, username)
+
+    def map(
+        self, job: Callable[[AccountClients], T], usernames: Optional[List[str]] = None
+    ) -> Dict[str, "Future[T]"]:
+        """Schedules `job` for every account (or only the given `usernames`)."""
+
+        return {
+            username: self.submit(username, job)
+            for username in (usernames if usernames is not None else self.accounts)
+        }
+
+    def sign_ins(self) -> int:
+        with self.lock:
+            return sum(clients.store.sign_ins for clients in self.clients.values())
+
+    def shutdown(self):
+        """Waits for all of the scheduled jobs to finish, and stops the workers."""
+
+        with self.idle:
+            self.idle.wait_for(lambda: len(self.running) == 0)
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
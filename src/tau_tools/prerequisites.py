@@ -3,8 +3,9 @@ import sys
 
 from bs4 import BeautifulSoup, Tag
 
+from tau_tools.instrumentation import instrumentation
 from tau_tools.logging import progress, setup_logging
-from tau_tools.utilities import request
+from tau_tools.utilities import has_markers, request
 
 
 def convert_table(table: Tag):
@@ -35,20 +36,20 @@ def convert_table(table: Tag):
 
 
 def get_prerequisites(course: str, group: str, year: int, semester: str):
-    page = BeautifulSoup(
-        request(
-            "GET",
-            f"https://www.ims.tau.ac.il/tal/kr/Drishot_L.aspx?kurs={course}&kv={group}&sem={year}{semester}",
-            cache_category="prerequisites",
-            cache_key=f"prerequisites-{course}{group}-{year}{semester}",
-            headers={
-                "User-Agent": "Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Mobile Safari/537.36,gzip(gfe)"
-            },
-        ),
-        "html.parser",
+    response_text = request(
+        "GET",
+        f"https://www.ims.tau.ac.il/tal/kr/Drishot_L.aspx?kurs={course}&kv={group}&sem={year}{semester}",
+        cache_category="prerequisites",
+        cache_key=f"prerequisites-{course}{group}-{year}{semester}",
+        headers={
+            "User-Agent": "Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Mobile Safari/537.36,gzip(gfe)"
+        },
+        validate=has_markers(r'class="[^"]*\btableblds\b'),
     )
-    table = page.find_all("table", {"class": "tableblds"})[-1]
-    return convert_table(table)
+    with instrumentation.timer("parse"):
+        page = BeautifulSoup(response_text, "html.parser")
+        table = page.find_all("table", {"class": "tableblds"})[-1]
+        return convert_table(table)
 
 
 def main(
@@ -84,11 +85,13 @@ def main(
                 progress.update(courses_task_id, advance=1)
             progress.update(courses_task_id, visible=False)
 
-        with open(
+        with instrumentation.timer("json write"), open(
             output_file_template.format(year=str(year + 1), semester=semester), "w"
         ) as f:
             json.dump(result, f, ensure_ascii=False)
 
+    instrumentation.report()
+
 
 if __name__ == "__main__":
     setup_logging()
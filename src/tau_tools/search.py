@@ -0,0 +1,372 @@
+"""
+A full-text search index over the course names, lecturers and syllabi of all of the scraped years.
+The index is saved in a binary format which is memory-mapped when loaded, so queries only read
+the parts of the index they need.
+
+Usage:
+    python3 -m tau_tools.search             Build `search-index.bin` from the JSONs in the current directory
+    python3 -m tau_tools.search <query>     Search the index
+"""
+
+import array
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from tau_tools.logging import console, log, setup_logging
+
+INDEX_FILE = "search-index.bin"
+MAGIC = b"TAUIDX01"
+HEADER_FORMAT = "<8sIII7Q"
+
+FIELD_WEIGHTS = {"name": 3.0, "lecturers": 2.0, "syllabus": 1.0}
+"""How much every occurrence of a term in each field counts"""
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+HEBREW_PREFIXES = [
+    "וכש",
+    "וש",
+    "וה",
+    "וב",
+    "וכ",
+    "ול",
+    "ומ",
+    "שה",
+    "שב",
+    "של",
+    "כש",
+    "מה",
+    "לכ",
+] + list("ובכלמשה")
+"""Prefixes which are attached to Hebrew words, longest first"""
+
+FINAL_LETTERS = str.maketrans("ךםןףץ", "כמנפצ")
+NIQQUD_REGEX = re.compile("[֑-ׇ]")
+TOKEN_REGEX = re.compile(r"[\w\"'״׳]+")
+HEBREW_REGEX = re.compile("^[א-ת]+$")
+
+
+def normalize(word: str) -> str:
+    """Lowercases the word, and removes niqqud, quotes (e.g. in abbreviations) and final letters."""
+
+    word = NIQQUD_REGEX.sub("", word.lower())
+    word = re.sub("[\"'״׳]", "", word)
+    return word.translate(FINAL_LETTERS)
+
+
+def get_variants(token: str) -> Set[str]:
+    """Returns the token, along with the token without every Hebrew prefix it may start with."""
+
+    variants = {token}
+    if HEBREW_REGEX.match(token):
+        for prefix in HEBREW_PREFIXES:
+            if token.startswith(prefix) and len(token) - len(prefix) >= 2:
+                variants.add(token[len(prefix) :])
+    return variants
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        token
+        for token in (normalize(word) for word in TOKEN_REGEX.findall(text))
+        if token != ""
+    ]
+
+
+@dataclass
+class SearchResult:
+    course_id: str
+    name: str
+    score: float
+
+
+class SearchIndex:
+    def __init__(self, path: str):
+        """Memory-maps the index at `path`."""
+
+        self.file = open(path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            self.doc_count,
+            self.term_count,
+            self.postings_count,
+            docs_offset,
+            docs_length,
+            doc_lengths_offset,
+            term_offsets_offset,
+            terms_offset,
+            postings_offsets_offset,
+            postings_offset,
+        ) = struct.unpack_from(HEADER_FORMAT, self.mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} isn't a search index")
+
+        self.documents: List[Tuple[str, str]] = json.loads(
+            self.mmap[docs_offset : docs_offset + docs_length]
+        )
+        view = memoryview(self.mmap)
+        self.doc_lengths = _cast(view, doc_lengths_offset, "f", self.doc_count)
+        self.term_offsets = _cast(view, term_offsets_offset, "I", self.term_count + 1)
+        self.terms_offset = terms_offset
+        self.postings_offsets = _cast(
+            view, postings_offsets_offset, "I", self.term_count + 1
+        )
+        self.postings_docs = _cast(view, postings_offset, "I", self.postings_count)
+        self.postings_weights = _cast(
+            view, postings_offset + 4 * self.postings_count, "f", self.postings_count
+        )
+        self.average_length = (
+            sum(self.doc_lengths) / self.doc_count if self.doc_count != 0 else 0
+        )
+
+    def close(self):
+        for view in [
+            self.doc_lengths,
+            self.term_offsets,
+            self.postings_offsets,
+            self.postings_docs,
+            self.postings_weights,
+        ]:
+            if isinstance(view, memoryview):
+                view.release()
+        self.mmap.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_term(self, i: int) -> bytes:
+        return self.mmap[
+            self.terms_offset
+            + self.term_offsets[i] : self.terms_offset
+            + self.term_offsets[i + 1]
+        ]
+
+    def _find_term(self, term: bytes) -> int:
+        """Returns the index of the first term which isn't smaller than `term`."""
+
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _iter_term_indices(self, term: str, is_prefix: bool) -> Iterator[int]:
+        encoded = term.encode()
+        i = self._find_term(encoded)
+        while i < self.term_count:
+            current = self._get_term(i)
+            if current == encoded or (is_prefix and current.startswith(encoded)):
+                yield i
+                i += 1
+            else:
+                return
+
+    def search(self, query: str, limit=10) -> List[SearchResult]:
+        """
+        Returns the courses which best match the query, ranked with BM25.
+        A word ending with `*` matches every word it's a prefix of.
+        """
+
+        scores: Dict[int, float] = {}
+        for word in query.split():
+            is_prefix = word.endswith("*")
+            for token in tokenize(word):
+                term_indices = set()
+                for variant in get_variants(token):
+                    term_indices.update(self._iter_term_indices(variant, is_prefix))
+
+                # A document matching several variants of the token only counts the best one.
+                token_scores: Dict[int, float] = {}
+                for i in term_indices:
+                    start, end = self.postings_offsets[i], self.postings_offsets[i + 1]
+                    df = end - start
+                    idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+                    for j in range(start, end):
+                        doc = self.postings_docs[j]
+                        tf = self.postings_weights[j]
+                        length_norm = (
+                            1
+                            - BM25_B
+                            + BM25_B * (self.doc_lengths[doc] / self.average_length)
+                        )
+                        score = idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+                        token_scores[doc] = max(token_scores.get(doc, 0), score)
+
+                for doc, score in token_scores.items():
+                    scores[doc] = scores.get(doc, 0) + score
+
+        best = sorted(scores.items(), key=lambda item: -item[1])[:limit]
+        return [
+            SearchResult(self.documents[doc][0], self.documents[doc][1], score)
+            for doc, score in best
+        ]
+
+
+def _cast(view: memoryview, offset: int, format: str, count: int):
+    section = view[offset : offset + 4 * count]
+    if sys.byteorder == "little":
+        return section.cast("B").cast(format)
+
+    # The index is little-endian, so it has to be copied on big-endian machines.
+    values = array.array(format, section.tobytes())
+    values.byteswap()
+    return values
+
+
+def _to_bytes(values: array.array) -> bytes:
+    if sys.byteorder != "little":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def build_index(documents: Dict[str, Dict[str, str]], path: str = INDEX_FILE):
+    """
+    Builds an index of the `documents` and saves it to `path`.
+    Every document is the text of every field (see `FIELD_WEIGHTS`) of a course, by its id.
+    """
+
+    course_ids = sorted(documents)
+    postings: Dict[str, Dict[int, float]] = {}
+    doc_lengths = array.array("f")
+    for doc, course_id in enumerate(course_ids):
+        length = 0.0
+        for field, text in documents[course_id].items():
+            weight = FIELD_WEIGHTS.get(field, 1.0)
+            for token in tokenize(text):
+                length += weight
+                for variant in get_variants(token):
+                    term_postings = postings.setdefault(variant, {})
+                    term_postings[doc] = term_postings.get(doc, 0) + weight
+        doc_lengths.append(length)
+
+    terms = sorted(postings, key=lambda term: term.encode())
+    term_offsets = array.array("I", [0])
+    terms_blob = bytearray()
+    postings_offsets = array.array("I", [0])
+    postings_docs = array.array("I")
+    postings_weights = array.array("f")
+    for term in terms:
+        terms_blob += term.encode()
+        term_offsets.append(len(terms_blob))
+        for doc, weight in sorted(postings[term].items()):
+            postings_docs.append(doc)
+            postings_weights.append(weight)
+        postings_offsets.append(len(postings_docs))
+
+    docs_blob = json.dumps(
+        [[course_id, documents[course_id].get("name", "")] for course_id in course_ids],
+        ensure_ascii=False,
+    ).encode()
+
+    sections = [
+        docs_blob,
+        _to_bytes(doc_lengths),
+        _to_bytes(term_offsets),
+        bytes(terms_blob),
+        _to_bytes(postings_offsets),
+        _to_bytes(postings_docs) + _to_bytes(postings_weights),
+    ]
+    offsets = []
+    offset = struct.calcsize(HEADER_FORMAT)
+    for section in sections:
+        # Keep the arrays aligned.
+        offset += -offset % 4
+        offsets.append(offset)
+        offset += len(section)
+
+    with open(path + ".part", "wb") as f:
+        f.write(
+            struct.pack(
+                HEADER_FORMAT,
+                MAGIC,
+                len(course_ids),
+                len(terms),
+                len(postings_docs),
+                offsets[0],
+                len(docs_blob),
+                *offsets[1:],
+            )
+        )
+        for section_offset, section in zip(offsets, sections):
+            f.write(b"\0" * (section_offset - f.tell()))
+            f.write(section)
+    os.replace(path + ".part", path)
+
+    log.info(f"Indexed {len(course_ids)} courses with {len(terms)} terms")
+
+
+def collect_documents(directory=".") -> Dict[str, Dict[str, str]]:
+    """Collects the names, lecturers and syllabi of the courses from the JSONs in the `directory`."""
+
+    names: Dict[str, str] = {}
+    lecturers: Dict[str, Set[str]] = {}
+    syllabi: Dict[str, List[str]] = {}
+
+    # The latest semester comes last, so its names are kept.
+    for filename in sorted(os.listdir(directory)):
+        path = os.path.join(directory, filename)
+        if filename.startswith("courses-") and filename.endswith(".json"):
+            with open(path, "r") as f:
+                courses = json.load(f)
+            for course_id, course in courses.items():
+                names[course_id] = course["name"]
+                for group in course["groups"]:
+                    if group["lecturer"] is not None:
+                        lecturers.setdefault(course_id, set()).update(
+                            lecturer
+                            for lecturer in group["lecturer"].split(", ")
+                            if lecturer != ""
+                        )
+        elif filename.startswith("syllabi-") and filename.endswith(".json"):
+            with open(path, "r") as f:
+                year_syllabi = json.load(f)
+            for course_id, syllabus in year_syllabi.items():
+                # Older outputs only contain the text of the syllabi.
+                text = syllabus if isinstance(syllabus, str) else syllabus["text"]
+                syllabi.setdefault(course_id, []).append(text)
+
+    return {
+        course_id: {
+            "name": names.get(course_id, ""),
+            "lecturers": " ".join(sorted(lecturers.get(course_id, []))),
+            "syllabus": "\n".join(syllabi.get(course_id, [])),
+        }
+        for course_id in set(names) | set(syllabi)
+    }
+
+
+def main(index_file=INDEX_FILE, query: Optional[str] = None, limit=10):
+    if query is None:
+        with console.status("Building the search index..."):
+            build_index(collect_documents(), index_file)
+        return
+
+    with SearchIndex(index_file) as index:
+        for result in index.search(query, limit):
+            console.print(f"{result.course_id} {result.name} ({result.score:.2f})")
+
+
+if __name__ == "__main__":
+    setup_logging()
+
+    if len(sys.argv) >= 2:
+        main(query=" ".join(sys.argv[1:]))
+    else:
+        main()
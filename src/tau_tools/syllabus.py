@@ -1,47 +1,243 @@
+import hashlib
 import json
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Comment, NavigableString, Tag
 
-from tau_tools.logging import progress, setup_logging
-from tau_tools.utilities import request
+from tau_tools.instrumentation import instrumentation
+from tau_tools.logging import log, progress, setup_logging
+from tau_tools.utilities import read_cache, send, set_rate_limit, write_cache
 
+IMS_HOST = "www.ims.tau.ac.il"
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36"
+}
+
+SECTION_KEYWORDS = {
+    "objectives": ["מטרות", "objectives", "goals"],
+    "grading": ["ציון", "הערכה", "grading", "grade", "assessment"],
+    "bibliography": ["ביבליוגרפיה", "קריאה", "bibliography", "reading"],
+}
+"""Keywords of the headings of the sections which are extracted into their own fields"""
+
+HEADING_TAGS = ["h1", "h2", "h3", "h4", "h5", "h6"]
+BLOCK_TAGS = ["p", "li", "div", "td", "th", "pre", "blockquote"]
+
+
+@dataclass
+class Syllabus:
+    group: str
+    """The group whose syllabus was scraped"""
+    text: str
+    """The full text of the syllabus"""
+    sections: Dict[str, str]
+    """The text of every section of the syllabus, by its heading"""
+    objectives: Optional[str]
+    grading: Optional[str]
+    bibliography: Optional[str]
+    hash: str
+    """The hash of the syllabus page, to find out whether it changed"""
+
+
+def _is_heading(element: Tag) -> bool:
+    return element.name in HEADING_TAGS or any(
+        "title" in class_name for class_name in element.get("class") or []
+    )
+
+
+def _contains_block(element: Tag) -> bool:
+    return (
+        element.name in BLOCK_TAGS
+        or _is_heading(element)
+        or element.find(BLOCK_TAGS) is not None
+        or element.find(_is_heading) is not None
+    )
+
+
+def parse_sections(contents: Tag) -> Dict[str, str]:
+    """Splits the syllabus contents into sections by their headings."""
+
+    sections: Dict[str, List[str]] = {}
+    heading = ""
+
+    def add_line(parts: List[str]):
+        text = " ".join(part for part in parts if part != "")
+        if text != "":
+            sections.setdefault(heading, []).append(text)
+
+    def walk(element: Tag):
+        nonlocal heading
+
+        # Text directly in the element (or in inline children) is a line of its own, even when
+        # the element also has block children.
+        inline_parts: List[str] = []
+        for child in element.children:
+            if isinstance(child, Tag) and child.name in ["script", "style"]:
+                continue
+            if isinstance(child, Tag) and _contains_block(child):
+                add_line(inline_parts)
+                inline_parts = []
+                if _is_heading(child):
+                    heading = child.get_text(" ", strip=True)
+                else:
+                    walk(child)
+            elif isinstance(child, Tag):
+                inline_parts.append(child.get_text(" ", strip=True))
+            elif isinstance(child, NavigableString) and not isinstance(child, Comment):
+                inline_parts.append(child.strip())
+        add_line(inline_parts)
+
+    walk(contents)
+    return {heading: "\n".join(lines) for heading, lines in sections.items()}
+
+
+def parse_syllabus(
+    response_text: str, group: str, page_hash: str
+) -> Optional[Syllabus]:
+    """Returns the syllabus in the page, or `None` if it has no syllabus."""
+
+    contents = BeautifulSoup(response_text, "html.parser").find(
+        "section", {"class": "main-course-contents"}
+    )
+    if contents is None:
+        return None
+
+    text = contents.text.strip()
+    if text == "":
+        return None
+
+    sections = parse_sections(contents)
+    fields: Dict[str, Optional[str]] = {}
+    for field_name, keywords in SECTION_KEYWORDS.items():
+        fields[field_name] = next(
+            (
+                section
+                for heading, section in sections.items()
+                if any(keyword in heading.lower() for keyword in keywords)
+            ),
+            None,
+        )
+
+    return Syllabus(group, text, sections, hash=page_hash, **fields)
+
+
+def _load_previous(output_file: str) -> Dict[str, Dict[str, Any]]:
+    if not os.path.exists(output_file):
+        return {}
+
+    try:
+        with open(output_file, "r") as f:
+            previous = json.load(f)
+    except json.JSONDecodeError:
+        log.warning(f"Couldn't load the previous syllabi from {output_file}")
+        return {}
+
+    # Older outputs only contain the text of the syllabi.
+    return {
+        course_id: syllabus
+        for course_id, syllabus in previous.items()
+        if isinstance(syllabus, dict)
+    }
+
+
+def main(
+    output_file_template="syllabi-{year}.json",
+    year=2024,
+    max_workers=8,
+    rate=5,
+    refresh=False,
+):
+    """
+    Fetches the syllabi of all of the courses in the `year`, with up to `max_workers` concurrent
+    requests, at most `rate` per second.
+    Courses in the previous output are skipped, unless `refresh` is set, in which case their pages
+    are fetched again and only parsed if they changed.
+    The output is written as the syllabi are fetched.
+    """
 
-def main(output_file_template="syllabi-{year}.json", year=2024):
     with open("courses-{year}a.json".format(year=year)) as f:
         courses = json.load(f)
     with open("courses-{year}b.json".format(year=year)) as f:
         courses = {**courses, **json.load(f)}
 
-    result = {}
-    with progress:
-        courses_task_id = progress.add_task(
-            "[purple]Fetching syllabi...", total=len(courses)
-        )
-        for course in sorted(courses.keys()):
-            first_group = courses[course]["groups"][0]["group"]
-            syllabus = (
-                BeautifulSoup(
-                    request(
-                        "GET",
-                        f"https://www.ims.tau.ac.il/Tal/Syllabus/Syllabus_L.aspx?course={course}{first_group}&year={year}",
-                        cache_category="syllabi",
-                        cache_key=f"syllabus-{course}{first_group}-{year}",
-                        headers={
-                            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36"
-                        },
-                    ),
-                    "html.parser",
-                )
-                .find("section", {"class": "main-course-contents"})
-                .text.strip()
+    output_file = output_file_template.format(year=str(year + 1))
+    previous = _load_previous(output_file)
+    set_rate_limit(IMS_HOST, rate)
+
+    def fetch_syllabus(course: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        try:
+            return course, get_syllabus(course)
+        except Exception as e:
+            log.warning(f"Failed fetching the syllabus of {course}: {e}")
+            # Keep the previous syllabus rather than dropping it from the output.
+            return course, previous.get(course)
+
+    def get_syllabus(course: str) -> Optional[Dict[str, Any]]:
+        first_group = courses[course]["groups"][0]["group"]
+        previous_syllabus = previous.get(course)
+        if (
+            not refresh
+            and previous_syllabus is not None
+            and previous_syllabus["group"] == first_group
+        ):
+            return previous_syllabus
+
+        cache_key = f"syllabus-{course}{first_group}-{year}"
+        response_text = None if refresh else read_cache("syllabi", cache_key)
+        if response_text is None:
+            response_text = send(
+                "GET",
+                f"https://{IMS_HOST}/Tal/Syllabus/Syllabus_L.aspx?course={course}{first_group}&year={year}",
+                headers=HEADERS,
+            ).text
+            write_cache("syllabi", cache_key, response_text)
+
+        page_hash = hashlib.sha256(response_text.encode()).hexdigest()
+        if previous_syllabus is not None and previous_syllabus["hash"] == page_hash:
+            return previous_syllabus
+
+        with instrumentation.timer("parse"):
+            syllabus = parse_syllabus(response_text, first_group, page_hash)
+        return asdict(syllabus) if syllabus is not None else None
+
+    partial_file = output_file + ".part"
+    count = 0
+    try:
+        with progress, ThreadPoolExecutor(max_workers) as executor, open(
+            partial_file, "w"
+        ) as f:
+            courses_task_id = progress.add_task(
+                "[purple]Fetching syllabi...", total=len(courses)
             )
-            if syllabus != "":
-                result[course] = syllabus
-            progress.update(courses_task_id, advance=1)
 
-    with open(output_file_template.format(year=str(year + 1)), "w") as f:
-        json.dump(result, f, ensure_ascii=False)
+            f.write("{")
+            for course, syllabus in executor.map(
+                fetch_syllabus, sorted(courses.keys())
+            ):
+                progress.update(courses_task_id, advance=1)
+                if syllabus is None:
+                    continue
+
+                with instrumentation.timer("json write"):
+                    if count != 0:
+                        f.write(",")
+                    f.write(
+                        f"{json.dumps(course)}:{json.dumps(syllabus, ensure_ascii=False)}"
+                    )
+                count += 1
+            f.write("}")
+    except BaseException:
+        os.remove(partial_file)
+        raise
+
+    os.replace(partial_file, output_file)
+    log.info(f"Wrote the syllabi of {count} of {len(courses)} courses")
+
+    instrumentation.report()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,250 @@
 import os
+import random
+import re
+import threading
 import time
-from typing import Any, Dict, Optional
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from tau_tools.instrumentation import instrumentation
+from tau_tools.logging import log
+
+
+class InvalidResponseException(Exception):
+    def __init__(self, response: requests.Response):
+        Exception.__init__(
+            self, f"Invalid response ({response.status_code}) from {response.url}"
+        )
+
+        self.response = response
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 5
+    backoff: float = 1
+    """The delay before the first retry, doubled on every following retry"""
+    max_backoff: float = 60
+    jitter: float = 0.5
+    """The relative amount of randomness added to every delay, between 0 and 1"""
+    timeout: float = 30
+    retry_statuses: Tuple[int, ...] = (429, 500, 502, 503, 504)
+
+    def get_delay(self, attempt_number: int) -> float:
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt_number - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class CircuitBreaker:
+    """
+    Pauses every request to a host after `failure_threshold` consecutive failures,
+    for `cooldown` seconds, so that all workers back off together when the servers are failing.
+    """
+
+    def __init__(self, failure_threshold=5, cooldown=60):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                remaining = self.open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self, host: str):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                log.warning(
+                    f"{host} failed {self.failures} times in a row, pausing for {self.cooldown} seconds"
+                )
+                self.failures = 0
+                self.open_until = time.monotonic() + self.cooldown
+
+
+class RateLimiter:
+    """Allows at most `rate` calls to `wait` per second, across all threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            scheduled_time = max(now, self.next_time)
+            self.next_time = scheduled_time + self.interval
+
+        if scheduled_time > now:
+            with instrumentation.timer("sleep"):
+                time.sleep(scheduled_time - now)
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(url: str) -> CircuitBreaker:
+    host = urlparse(url).netloc
+    with _circuit_breakers_lock:
+        if host not in _circuit_breakers:
+            _circuit_breakers[host] = CircuitBreaker()
+        return _circuit_breakers[host]
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def set_rate_limit(host: str, rate: float):
+    """Limit all requests sent to `host` (e.g. `moodle.tau.ac.il`) to `rate` per second."""
+
+    with _rate_limiters_lock:
+        _rate_limiters[host] = RateLimiter(rate)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    A transport adapter limiting the requests to every host by `rate_limiters` (keyed by the host),
+    for rate limits which only apply to the sessions it's mounted on.
+    """
+
+    def __init__(self, rate_limiters: Dict[str, RateLimiter], **kwargs):
+        super().__init__(**kwargs)
+        self.rate_limiters = rate_limiters
+
+    def send(self, request: requests.PreparedRequest, *args, **kwargs):
+        rate_limiter = self.rate_limiters.get(urlparse(request.url).netloc)
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        return super().send(request, *args, **kwargs)
+
+
+def send(
+    method: str,
+    url: str,
+    s: Optional[requests.Session] = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    validate: Optional[Callable[[requests.Response], bool]] = None,
+    on_retry: Optional[Callable[[Exception], None]] = None,
+    **kwargs,
+) -> requests.Response:
+    """
+    Send a request, retrying with exponential backoff on network errors, server errors
+    and responses rejected by `validate`. `on_retry` is called with the error before every retry.
+    Raises the last error if all of the attempts failed.
+    """
+
+    host = urlparse(url).netloc
+    circuit_breaker = get_circuit_breaker(url)
+    rate_limiter = _rate_limiters.get(host)
+    kwargs.setdefault("timeout", retry_policy.timeout)
+
+    error: Exception = Exception(f"No attempts were made to request {url}")
+    for attempt_number in range(1, retry_policy.max_attempts + 1):
+        circuit_breaker.wait()
+        if rate_limiter is not None:
+            rate_limiter.wait()
+
+        start = time.perf_counter()
+        try:
+            with instrumentation.timer("network"):
+                response = (
+                    s.request(method, url, **kwargs)
+                    if s is not None
+                    else requests.request(method, url, **kwargs)
+                )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            circuit_breaker.record_failure(host)
+            error = e
+        else:
+            instrumentation.record_url(url, time.perf_counter() - start)
+            if response.status_code in retry_policy.retry_statuses:
+                circuit_breaker.record_failure(host)
+                error = InvalidResponseException(response)
+            else:
+                circuit_breaker.record_success()
+                # Other client errors won't be fixed by retrying.
+                response.raise_for_status()
+                if validate is None or validate(response):
+                    return response
+                error = InvalidResponseException(response)
+
+        if attempt_number < retry_policy.max_attempts:
+            delay = retry_policy.get_delay(attempt_number)
+            log.warning(
+                f"Attempt {attempt_number} to request {url} failed ({error}), retrying in {delay:.1f} seconds"
+            )
+            instrumentation.count("retries")
+            if on_retry is not None:
+                on_retry(error)
+            with instrumentation.timer("sleep"):
+                time.sleep(delay)
+
+    raise error
+
+
+def has_markers(*patterns: str) -> Callable[[requests.Response], bool]:
+    """
+    Returns a validator accepting only pages matching all of the regular expressions `patterns`
+    (e.g. `'id="__VIEWSTATE"'`), so that error and login pages aren't cached.
+    The pages are searched rather than parsed, since the callers parse them anyway.
+    """
+
+    compiled_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+
+    def validate(response: requests.Response) -> bool:
+        return all(
+            pattern.search(response.text) is not None for pattern in compiled_patterns
+        )
+
+    return validate
+
+
+def _get_cache_file(cache_category: Optional[str], cache_key: str) -> str:
+    if cache_category is None:
+        return f"cache/{cache_key}.txt"
+    return f"cache-{cache_category}/{cache_key}.txt"
+
+
+def read_cache(cache_category: Optional[str], cache_key: str) -> Optional[str]:
+    """Returns the cached response text, or `None` if it's missing or `TAU_TOOLS_FORCE_FETCH` is set."""
+
+    cache_file = _get_cache_file(cache_category, cache_key)
+    if not os.path.exists(cache_file) or (
+        "TAU_TOOLS_FORCE_FETCH" in os.environ
+        and len(os.environ["TAU_TOOLS_FORCE_FETCH"]) != 0
+    ):
+        instrumentation.record_cache(str(cache_category), False)
+        return None
+
+    instrumentation.record_cache(str(cache_category), True)
+    with instrumentation.timer("cache read"), open(cache_file, "r") as f:
+        return f.read()
+
+
+def write_cache(cache_category: Optional[str], cache_key: str, text: str):
+    cache_file = _get_cache_file(cache_category, cache_key)
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    with instrumentation.timer("cache write"), open(cache_file, "w") as f:
+        f.write(text)
 
 
 def request(
@@ -15,37 +257,44 @@ def request(
     headers: Optional[Dict[str, str]] = None,
     cache_category: Optional[str] = None,
     cache_key: Optional[str] = None,
+    retry_policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    validate: Optional[Callable[[requests.Response], bool]] = None,
 ) -> str:
-    if cache_category is None:
-        cache_file = f"cache/{cache_key}.txt"
-    else:
-        cache_file = f"cache-{cache_category}/{cache_key}.txt"
-
-    if (
-        cache_key is not None
-        and os.path.exists(cache_file)
-        and not (
-            "TAU_TOOLS_FORCE_FETCH" in os.environ
-            and len(os.environ["TAU_TOOLS_FORCE_FETCH"]) != 0
+    """
+    Send a request and return the response text, caching it under `cache_key`.
+    Responses rejected by `validate` are retried and never cached, and so are client errors,
+    whose text is returned as is.
+    """
+
+    if cache_key is not None:
+        response_text = read_cache(cache_category, cache_key)
+        if response_text is not None:
+            return response_text
+
+    try:
+        response = send(
+            method,
+            url,
+            s,
+            retry_policy,
+            validate,
+            json=json,
+            data=data,
+            headers=headers,
         )
-    ):
-        with open(cache_file, "r") as f:
-            response_text = f.read()
-        return response_text
+    except requests.HTTPError as e:
+        if e.response is None:
+            raise
+        log.warning(f"Got {e.response.status_code} from {url}, not caching it")
+        with instrumentation.timer("sleep"):
+            time.sleep(delay)
+        return e.response.text
 
-    response = (
-        s.request(method, url, json=json, data=data, headers=headers)
-        if s is not None
-        else requests.request(method, url, json=json, data=data, headers=headers)
-    )
-    time.sleep(delay)
+    with instrumentation.timer("sleep"):
+        time.sleep(delay)
 
     if cache_key is not None:
-        cache_directory = os.path.dirname(os.path.abspath(cache_file))
-        if not os.path.isdir(cache_directory):
-            os.mkdir(cache_directory)
-        with open(cache_file, "w") as f:
-            f.write(response.text)
+        write_cache(cache_category, cache_key, response.text)
 
     return response.text
 